@@ -10,8 +10,10 @@ bl_info = {
 
 if "bpy" in locals():
     import importlib
+    importlib.reload(stf_render)
     importlib.reload(export_msts)
 else:
+    from . import stf_render
     from . import export_msts
 
 def register():
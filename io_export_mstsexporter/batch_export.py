@@ -0,0 +1,168 @@
+'''
+Exports many .blend files without the user interface, eg to rebuild every shape of a route.
+
+    blender -b --python batch_export.py -- manifest.json summary.json [ --jobs 4 ] [ --timeout 600 ]
+
+or from a plain python, giving the Blender to run
+
+    python batch_export.py manifest.json summary.json --blender /path/to/blender
+
+manifest.json lists the shapes to export, relative paths are relative to the manifest:
+
+    [ { "blend" : "shapes/loco.blend", "output" : "out/loco.s", "root" : [ "MAIN", "SNOWPLOW" ], "options" : { "CompactTables" : true } },
+      ... ]
+
+root is a collection name or a list of them, the first is written to output and the others alongside it,
+eg out/loco_SNOWPLOW.s, the options are those of the export dialog, see export_msts.ExportOptions,
+the root collections and any options not given are the MSTS settings saved in the .blend file.
+
+Each shape is exported by its own background Blender process, up to --jobs of them at once ( default one per core ).
+summary.json lists the result of every .blend file, in manifest order, with its status ( "ok", "failed" or "timeout" ),
+error message, the files written ( none when the options ask for EstimateOnly ),
+export time and elapsed time in seconds ( including starting Blender ),
+the exit code is 1 when any failed.
+'''
+
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+try:
+    import bpy
+except ImportError:     # run from a plain python, only to start the Blender processes
+    bpy = None
+
+
+ErrorLines = 20     # lines of a failed Blender process's output kept in the summary
+
+
+#####################################
+# import the add-on package this script is in, registering it if it isn't already enabled
+def ImportAddon():
+    import importlib
+    packageFolder = os.path.dirname( os.path.abspath( __file__ ) )
+    sys.path.insert( 0, os.path.dirname( packageFolder ) )
+    package = importlib.import_module( os.path.basename( packageFolder ) )
+    if not hasattr( bpy.types.Scene, 'msts' ):
+        package.register()
+    return package.export_msts
+
+
+#####################################
+# in the Blender process started for one shape, with its .blend file open
+# export it and write the result to resultPath
+def ExportJob( job, resultPath ):
+
+    result = { 'status':'ok', 'error':None, 'outputs':[] }
+    startTime = time.time()
+    try:
+        export_msts = ImportAddon()
+        os.makedirs( os.path.dirname( os.path.abspath( job['output'] ) ), exist_ok=True )
+        try:
+            result['outputs'] = export_msts.ExportShapeAs( bpy.context, job['root'], job['output'], job['options'] )
+        except export_msts.MyException as error:
+            result.update( status='failed', error=' '.join( error.args ) )
+    except Exception:
+        result.update( status='failed', error=traceback.format_exc() )
+    result['time'] = round( time.time() - startTime, 2 )
+    with open( resultPath, 'w' ) as f:
+        json.dump( result, f )
+
+
+#####################################
+# run a background Blender process to export one shape of the manifest, return its summary entry
+def RunJob( blender, job, resultPath, timeout ):
+
+    entry = { 'blend':job['blend'], 'output':job['output'], 'root':job['root'], 'outputs':[], 'time':None }
+    command = [ blender, '-b', job['blend'], '--python', os.path.abspath( __file__ ), '--', '--job', json.dumps( job ), resultPath ]
+    startTime = time.time()
+    try:
+        process = subprocess.run( command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout )
+    except subprocess.TimeoutExpired:
+        entry.update( status='timeout', error='Timed out after {0} sec'.format( timeout ), elapsed=round( time.time() - startTime, 2 ) )
+        return entry
+    if os.path.exists( resultPath ):
+        with open( resultPath ) as f:
+            entry.update( json.load( f ) )
+    else:   # Blender didn't get as far as the export, eg the .blend file couldn't be opened
+        output = process.stdout.decode( 'utf-8', 'replace' ).splitlines()
+        entry.update( status='failed', error='\n'.join( output[ -ErrorLines: ] ) )
+    entry['elapsed'] = round( time.time() - startTime, 2 )    # including starting Blender and loading the .blend file
+    return entry
+
+
+#####################################
+# read the manifest, making its paths absolute and filling in the defaults
+def ReadManifest( manifestPath ):
+
+    folder = os.path.dirname( os.path.abspath( manifestPath ) )
+    with open( manifestPath ) as f:
+        manifest = json.load( f )
+    shapes = []
+    for eachShape in manifest:
+        root = eachShape.get( 'root' )
+        if isinstance( root, str ):
+            root = [ root ]
+        shapes.append( { 'blend':os.path.join( folder, eachShape['blend'] ),
+                         'output':os.path.join( folder, eachShape['output'] ),
+                         'root':root,
+                         'options':eachShape.get( 'options', {} ) } )
+    return shapes
+
+
+#####################################
+# export every shape of the manifest over a pool of Blender processes and write the summary
+# return the number of shapes that failed
+def RunBatch( manifestPath, summaryPath, blender, jobs, timeout ):
+
+    shapes = ReadManifest( manifestPath )
+    startTime = time.time()
+    with tempfile.TemporaryDirectory( prefix='msts_batch_' ) as resultFolder:
+        with concurrent.futures.ThreadPoolExecutor( jobs ) as pool:     # the threads only wait on the processes
+            futures = [ pool.submit( RunJob, blender, eachShape, os.path.join( resultFolder, '{0}.json'.format( i ) ), timeout )
+                        for i, eachShape in enumerate( shapes ) ]
+            entries = []
+            for eachFuture in futures:
+                entry = eachFuture.result()
+                print( "{0:8} {1:8.1f} sec  {2}".format( entry['status'].upper(), entry['elapsed'], entry['output'] ) )
+                entries.append( entry )
+
+    failed = sum( 1 for entry in entries if entry['status'] != 'ok' )
+    summary = { 'shapes':len( entries ), 'failed':failed, 'time':round( time.time() - startTime, 2 ), 'results':entries }
+    with open( summaryPath, 'w' ) as f:
+        json.dump( summary, f, indent=2 )
+    print( "{0} OK, {1} FAILED, IN {2:.1f} sec".format( len( entries ) - failed, failed, summary['time'] ) )
+    return failed
+
+
+#####################################
+def main():
+
+    argv = sys.argv[ sys.argv.index( '--' ) + 1: ] if '--' in sys.argv else sys.argv[1:]
+    if len( argv ) > 0 and argv[0] == '--job':
+        ExportJob( json.loads( argv[1] ), argv[2] )
+        return
+
+    parser = argparse.ArgumentParser( prog='batch_export.py', description='Export the shapes listed in a manifest, each in a background Blender' )
+    parser.add_argument( 'manifest', help='json list of { blend, output, root, options } for each shape' )
+    parser.add_argument( 'summary', help='json file the results are written to' )
+    parser.add_argument( '--blender', default=bpy.app.binary_path if bpy != None else 'blender', help='the Blender executable, defaults to the one running this script' )
+    parser.add_argument( '--jobs', type=int, default=os.cpu_count() or 1, help='shapes exported at once, defaults to the number of cores' )
+    parser.add_argument( '--timeout', type=float, default=None, help='seconds before an export is abandoned' )
+    args = parser.parse_args( argv )
+    if shutil.which( args.blender ) == None:
+        parser.error( 'Blender not found: ' + args.blender )
+
+    failed = RunBatch( args.manifest, args.summary, args.blender, max( 1, args.jobs ), args.timeout )
+    sys.exit( 1 if failed > 0 else 0 )
+
+
+if __name__ == "__main__":
+    main()
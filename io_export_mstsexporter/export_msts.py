@@ -102,7 +102,6 @@ IDEAS FUTURE
         - zBias
         - use of lod_control objects to improve LOD efficiency
     - option to export texture files
-    - option to compress shape file
     - options to generate .SD, .ENG, .WAG or .REF
 
 '''
@@ -110,20 +109,26 @@ IDEAS FUTURE
 import bpy
 import os
 import re
-from math import radians
+from math import radians, floor
+from itertools import product
+from collections import OrderedDict
+from array import array
 from bpy.props import StringProperty, EnumProperty, BoolProperty
 import mathutils
 from mathutils import *
+import numpy        # ships with Blender
+import time
 
 class MyException( Exception ):
         pass
 
 MaxVerticesPerPrimitive = 8000     # 8000 OK 20000 Fails
 MaxVerticesPerSubObject = 15000      # 15000 OK 20000 Fails, Note: Spike reports 14000 failed, he uses 12000
+VertexWeldBatch = 15000       # triangles welded into vertices at a time by AddTrianglesToSubObject
+MeshCacheCorners = 3000000    # triangle corners of extracted mesh data kept in memory for reuse by later distance levels
 
-FastExport = True       # do less compaction to reduce export time at cost of slightly larger file size
-                        # no impact on frame rates for most files, very large files may see a couple of additional Draw calls
-                        # eg L1-huge.blend exports in 28 sec vs 11 min 42 sec, file size = 63,628,192  vs 55,423,130 bytes
+# approximate size of the repeated parts of a shape, for EstimateOnly, in characters, measured on exported shapes
+EstimateTextSizes = { 'point':48, 'uv_point':35, 'vector':48, 'vertex':175, 'triangle':34, 'sub_object':1500, 'shape':5000 }
 
 HierarchyOptimization = True  # gives better triangle fill, reduces subobject splitting in middle of primitive,
                               # creates new subobjects for each hierarchy level
@@ -134,6 +139,15 @@ RetainNames = False   # user option, when true, the exporter disables mesh
                       # consolidation and hierarchy collapse optimizations
                       # reduces frame rates due to more Draw Calls
 UseDDS = False
+CompactTables = False   # user option, when true, a final pass removes duplicate and unused
+                        # uv points, normals, colours, light materials, vertex states and prim states
+CompressShape = False   # user option, when true, the shape file is zlib compressed ( SIMISA@F )
+                        # only for scripts until compressed shapes have been loaded in OpenRails
+LowMemory = False   # user option, when true, each distance level is kept in a temporary file once it is complete
+                    # so only one distance level at a time is held in memory, see DistanceLevel.Spill
+                    # the text writer streams the file as it is written, see STFWriter
+EstimateOnly = False    # user option, when true, the triangles of the shape are counted but not built or written,
+                        # the summary of each LOD is reported along with the approximate file size
 
 BlenderVersion = bpy.app.version    # returns tuple of (major, minor, subversion)
 
@@ -231,57 +245,47 @@ class MSTSExporter(bpy.types.Operator, ExportHelper):
         layout = self.layout
 
         layout.prop( self, "filepath" )
+        layout.prop( settings, "RootCollections" )
         layout.prop( settings, "RetainNames" )
         layout.prop( settings, "UseDDS" )
+        layout.prop( settings, "CompactTables" )
+        # CompressShape is left out until compressed shapes have been loaded in OpenRails
+        layout.prop( settings, "LowMemory" )
+        layout.prop( settings, "EstimateOnly" )
 
     def execute(self, context):
 
         settings = context.scene.msts
 
-        global RetainNames
-        RetainNames = settings.RetainNames
-        global UseDDS
-        UseDDS = settings.UseDDS
-
         #Append .s
         exportPath = bpy.path.ensure_ext(self.filepath, ".s")
         settings.SFilepath = TryGetRelPath( exportPath )
 
-        # Validate root object
-        rootName = 'MAIN'
-        rootCollection = bpy.context.scene.collection.children.get( rootName )
-        if rootCollection == None:
-            print()
-            print( "ERROR: MAIN not found in Scene Collection.")
-            self.report( {'ERROR'}, "MAIN not found in Scene Collection" )
-            return {'CANCELLED' }
-
-        #force out of edit mode
-        if bpy.context.mode != 'OBJECT':
-            bpy.ops.object.mode_set( mode = 'OBJECT' )
-
-        #Export
-        print()
-        print( "EXPORTING "+rootName + " TO " + exportPath )
-        print()
-        global ProgressContext
-        ProgressContext = context
-        context.window_manager.progress_begin( 0,1 )   # progress bar indication ( forthcoming feature )
-        UpdateProgress()
+        # Validate root objects
+        rootNames = RootCollectionNames( settings )
+        for eachName in rootNames:
+            rootCollection = bpy.context.scene.collection.children.get( eachName )
+            if rootCollection == None:
+                print()
+                print( "ERROR: " + eachName + " not found in Scene Collection.")
+                self.report( {'ERROR'}, eachName + " not found in Scene Collection" )
+                return {'CANCELLED' }
+
         try:
-            ExportShapeFile( rootName, exportPath )
+            ExportShapeAs( context, rootNames, exportPath, { 'CompressShape':False } )
 
+            if EstimateOnly:
+                print( "FINISHED ESTIMATE" )
+                self.report( {'INFO'}, "Estimate only, no file written, see the console for each LOD" )
+                return {"FINISHED"}
             print( "FINISHED OK" )
             self.report( {'INFO'}, "Finished OK" )
             return {"FINISHED"}
         except MyException as error:   # when we raise an error it comes here
-            context.window_manager.progress_end()
             print( "ERROR: " + ' '.join(error.args) )
             self.report( {'WARNING'}, ' '.join(error.args) )
             return { "CANCELLED" }
         # all other exceptions are passed up for traceback
-        finally:
-            context.window_manager.progress_end()
 
     def cancel( self, message ):
         print( "ERROR: ", message )
@@ -289,6 +293,70 @@ class MSTSExporter(bpy.types.Operator, ExportHelper):
         return {'CANCELLED' }
 
 
+#####################################
+# the user options that ExportShapeAs accepts, see the globals of the same names
+ExportOptions = ( 'RetainNames', 'UseDDS', 'CompactTables', 'CompressShape', 'LowMemory', 'EstimateOnly' )
+
+#####################################
+# the root collections named in the MSTS settings, eg 'MAIN, SNOWPLOW'
+def RootCollectionNames( settings ):
+    return [ eachName.strip() for eachName in settings.RootCollections.split( ',' ) if eachName.strip() != '' ]
+
+#####################################
+# export root collections of the scene, for the operator and for scripts, see batch_export.py
+# rootNames is a list of collection names, or None for the scene's Root Collections setting
+# the first is exported to exportPath, the others alongside it, see RootExportPath
+# the user options are the scene's MSTS settings, except those given in options, eg { 'CompactTables':True }
+# returns the files written ( none for EstimateOnly ), raises MyException when the shapes can't be exported
+def ExportShapeAs( context, rootNames, exportPath, options = None ):
+
+    options = options or {}
+    for eachName in options:
+        if eachName not in ExportOptions:
+            raise MyException( "Unknown export option: " + eachName )
+
+    settings = context.scene.msts
+
+    global RetainNames
+    RetainNames = options.get( 'RetainNames', settings.RetainNames )
+    global UseDDS
+    UseDDS = options.get( 'UseDDS', settings.UseDDS )
+    global CompactTables
+    CompactTables = options.get( 'CompactTables', settings.CompactTables )
+    global CompressShape
+    CompressShape = options.get( 'CompressShape', settings.CompressShape )
+    global LowMemory
+    LowMemory = options.get( 'LowMemory', settings.LowMemory )
+    global EstimateOnly
+    EstimateOnly = options.get( 'EstimateOnly', settings.EstimateOnly )
+
+    if rootNames == None:
+        rootNames = RootCollectionNames( settings )
+    if len( rootNames ) == 0:
+        raise MyException( "No root collections to export, eg MAIN" )
+    for eachName in rootNames:
+        if context.scene.collection.children.get( eachName ) == None:
+            raise MyException( eachName + " not found in Scene Collection" )
+
+    #force out of edit mode
+    if context.mode != 'OBJECT':
+        bpy.ops.object.mode_set( mode = 'OBJECT' )
+
+    #Export
+    print()
+    for i in range( 0, len( rootNames ) ):
+        print( "EXPORTING "+rootNames[i] + " TO " + RootExportPath( exportPath, rootNames, i ) )
+    print()
+    global ProgressContext
+    ProgressContext = context
+    context.window_manager.progress_begin( 0,1 )   # progress bar indication ( forthcoming feature )
+    UpdateProgress()
+    try:
+        return ExportShapeFiles( rootNames, exportPath )
+    finally:
+        context.window_manager.progress_end()
+
+
 def menu_func(self, context):
     self.layout.operator(MSTSExporter.bl_idname, text="OpenRails/MSTS (.s)")
 
@@ -775,11 +843,25 @@ class msts_scene_props(bpy.types.PropertyGroup):
 
     SFilepath : StringProperty( default = "" )
 
+    RootCollections : StringProperty(name='Root Collections', description = 'Collections to export, separated by commas, each with its own LOD collections eg MAIN_2000. The first is written to the chosen file, the others alongside it, eg loco_SNOWPLOW.s', default = 'MAIN' )
+
     RetainNames : BoolProperty(name='Retain Names', description = 'Disables object merging optimizations', default = False )
 
 
     UseDDS : BoolProperty(name='Use DDS', description = 'Export Texture type as DDS instead of ACE', default = False )
 
+
+    CompactTables : BoolProperty(name='Compact Tables', description = 'Remove duplicate and unused table entries for the smallest file, takes longer', default = False )
+
+
+    CompressShape : BoolProperty(name='Compress', description = 'Write the shape file zlib compressed', default = False )
+
+
+    LowMemory : BoolProperty(name='Low Memory', description = 'Keep completed LODs in temporary files while exporting, for shapes too large to hold in memory, takes longer', default = False )
+
+
+    EstimateOnly : BoolProperty(name='Estimate Only', description = 'Report the triangles, draw calls and approximate file size of each LOD without writing the shape', default = False )
+
 '''
 This code converts from Blender data structures to MSTS data structures
 from here down to the Library section, the code uses blender coordinate system unless specified as MSTS
@@ -837,22 +919,18 @@ def GetNormalsOverride( propertyString, initialNormal ):
 #####################################
 def iShaderAdd( shaderName ):
 
-    if shaderName in ExportShape.Shaders:
-        iShader = ExportShape.Shaders.index(shaderName)
-    else:
-        iShader = len( ExportShape.Shaders )
-        ExportShape.Shaders.append( shaderName )
+    iShader = ExportShape.Shaders.Find( shaderName )
+    if iShader == -1:
+        iShader = ExportShape.Shaders.Add( shaderName, shaderName )
     return iShader
 
 
 #####################################
 def iFilterAdd( filterName ):
 
-    if filterName in ExportShape.Filters:
-        iFilter = ExportShape.Filters.index( filterName )
-    else:
-        iFilter = len( ExportShape.Filters )
-        ExportShape.Filters.append( filterName )
+    iFilter = ExportShape.Filters.Find( filterName )
+    if iFilter == -1:
+        iFilter = ExportShape.Filters.Add( filterName, filterName )
     return iFilter
 
 
@@ -867,12 +945,9 @@ def iImageAdd( imageName ):
     else:
         imageName = imageName + '.dds'
 
-    for iImage in range(0, len( ExportShape.Images)):
-        if ExportShape.Images[iImage] == imageName:
-            return iImage
-
-    iImage = len( ExportShape.Images)
-    ExportShape.Images.append( imageName)
+    iImage = ExportShape.Images.Find( imageName )
+    if iImage == -1:
+        iImage = ExportShape.Images.Add( imageName, imageName )
     return iImage
 
 
@@ -881,54 +956,44 @@ def iTextureAdd( imageName, mipMapLODBias ):   # creates both texture and image
 
     iImage = iImageAdd( imageName )
 
-    for iTexture in range( 0, len( ExportShape.Textures)):
-        texture = ExportShape.Textures[iTexture]
-        if texture.iImage == iImage and texture.MipMapLODBias == mipMapLODBias:
-            return iTexture
+    key = ( iImage, mipMapLODBias )
+    iTexture = ExportShape.Textures.Find( key )
+    if iTexture != -1:
+        return iTexture
 
-    iTexture = len( ExportShape.Textures )
     newTexture = Texture()
     newTexture.iImage = iImage
     newTexture.iFilter = iFilterAdd( 'MipLinear' )
     newTexture.MipMapLODBias = mipMapLODBias
-    ExportShape.Textures.append( newTexture )
-    return iTexture
+    return ExportShape.Textures.Add( key, newTexture )
 
 #####################################
-def UVOpsMatch( opsList,  specifierList ):       # specifiers is a list ( operation, textureAddressMode ) pairs
+def UVOpsKey( specifierList ):       # specifiers is a list ( operation, textureAddressMode ) pairs
 
-    if len( opsList ) != len( specifierList ):
-        return False
-    for i in range( 0, len( opsList ) ):
-        eachUVOp = opsList[i]
-        operation = specifierList[i][0]
-        if eachUVOp.__class__ != operation: return False
-        if operation == UVOpCopy and eachUVOp.TextureAddressMode != specifierList[i][1]: return False
-        elif operation == UVOpReflectMapFull: continue
-    return True
+    # the texture address mode only matters for a copy
+    return tuple( ( operation, textureAddressMode if operation == UVOpCopy else None ) for operation, textureAddressMode in specifierList )
 
 #####################################
 def iLightConfigAdd( uvops ):    # it a list of   ( operation, textureAddressMode ) pairs
 
     # see if its already set up
-    for i in range( 0, len( ExportShape.LightConfigs ) ):
-        if UVOpsMatch( ExportShape.LightConfigs[i].UVOps, uvops ):
-                return i
+    key = UVOpsKey( uvops )
+    i = ExportShape.LightConfigs.Find( key )
+    if i != -1:
+        return i
 
     # no, so create it
-    i = len( ExportShape.LightConfigs )
     newLightConfig = LightConfig()
     for eachop in uvops:
         if eachop[0] == UVOpCopy:
             newUVOp = UVOpCopy()
             newUVOp.TextureAddressMode = eachop[1]
-        elif op[0] == UVOpReflectMapFull:
+        elif eachop[0] == UVOpReflectMapFull:
             newUVOp = UVOpReflectMapFull()
         else:
             raise Exception( "PROGRAM ERROR: UNDEFINED UV OPERATION" )
         newLightConfig.UVOps.append( newUVOp )
-    ExportShape.LightConfigs.append( newLightConfig )
-    return i
+    return ExportShape.LightConfigs.Add( key, newLightConfig )
 
 #####################################
 def iColorAdd( color ):   # a r g b
@@ -943,40 +1008,18 @@ def iLightMaterialAdd( lm ):  # diff, amb, spec, emmisive, power
 
 #####################################
 def iVertexStateAdd( flags, iMatrix, iLightMaterial, iLightConfig ):
-    i = len( ExportShape.VertexStates )  # use the last correct entry - earlier ones will have a full vtx_set
-    while i > 0:
-        i -= 1
-        eachVertexState = ExportShape.VertexStates[i]
-        if eachVertexState.Flags == flags \
-          and eachVertexState.iMatrix == iMatrix \
-          and eachVertexState.iLightMaterial == iLightMaterial \
-          and eachVertexState.iLightConfig == iLightConfig:
-            # we found one
-            return i
-    # we didn't find it, so add it and add a corresponding vertex set to every sub_object
-    i = len( ExportShape.VertexStates )
+    key = ( flags, iMatrix, iLightMaterial, iLightConfig )
+    i = ExportShape.VertexStates.Find( key )  # the table returns the last correct entry - earlier ones will have a full vtx_set
+    if i != -1:
+        # we found one
+        return i
+    # we didn't find it, so add it, sub_objects create the matching vertex_set when they first use it
     newVertexState = VertexState()
     newVertexState.Flags = flags
     newVertexState.iMatrix = iMatrix
     newVertexState.iLightMaterial = iLightMaterial
     newVertexState.iLightConfig = iLightConfig
-    ExportShape.VertexStates.append( newVertexState )
-    # every vertex_state needs a matching vertex_set
-    for lodControl in ExportShape.LodControls:
-        for distanceLevel in lodControl.DistanceLevels:
-            for subobject in distanceLevel.SubObjects:
-                subobject.VertexSets.append( VertexSet() ) #Note: unused vertexSets are purged during write
-    return i
-
-#####################################
-def MatchList( lista, listb ):
-
-    if len(lista) != len(listb):
-        return False
-    for i in range( 0, len(lista) ):
-        if lista[i] != listb[i]:
-            return False
-    return True
+    return ExportShape.VertexStates.Add( key, newVertexState )
 
 #####################################
 def ColorWord( floats ):
@@ -1025,18 +1068,12 @@ def iPrimStateAdd( iVertexState, zBias, iShader, alphaTestMode, iLightConfig, iT
     global ExportShape
 
     # see if this one's already set up
-    for i in range( 0, len( ExportShape.PrimStates ) ):
-        eachPrimState = ExportShape.PrimStates[i]
-        if eachPrimState.iVertexState == iVertexState \
-          and eachPrimState.zBias == zBias \
-          and eachPrimState.iShader == iShader \
-          and eachPrimState.AlphaTestMode == alphaTestMode \
-          and eachPrimState.iLightConfig == iLightConfig \
-          and MatchList( eachPrimState.iTextures, iTextures ):
-                return i
+    key = ( iVertexState, zBias, iShader, alphaTestMode, iLightConfig, tuple( iTextures ) )
+    i = ExportShape.PrimStates.Find( key )
+    if i != -1:
+        return i
 
     # we didn't find it so add it
-    i = len( ExportShape.PrimStates )
     newPrimState = PrimState()
     iHierarchy = ExportShape.VertexStates[iVertexState].iMatrix
     newPrimState.Label = ExportShape.Matrices[iHierarchy].Label
@@ -1051,8 +1088,7 @@ def iPrimStateAdd( iVertexState, zBias, iShader, alphaTestMode, iLightConfig, iT
     newPrimState.iShader = iShader
     newPrimState.AlphaTestMode = alphaTestMode
     newPrimState.iLightConfig = iLightConfig
-    ExportShape.PrimStates.append( newPrimState )
-    return i
+    return ExportShape.PrimStates.Add( key, newPrimState )
 
 
 #####################################
@@ -1062,30 +1098,31 @@ def iPrimitiveAppend( subObject, iPrimState ):
     newPrimitive = Primitive()
     newPrimitive.iPrimState = iPrimState
     subObject.Primitives.append( newPrimitive )
+    subObject.iLastPrimitives[iPrimState] = i
     return i
 
 #####################################
 def iPrimitiveAdd( subObject, iPrimState ):
 
-    i = len( subObject.Primitives )
-    while i > 0:                                                # use the last correct entry - earlier ones could be full
-        i -= 1
-        primitive = subObject.Primitives[i]
-        if primitive.iPrimState == iPrimState:
-            return i
-    #we didn't find it, so add a new one
-    i = iPrimitiveAppend( subObject, iPrimState )
+    i = subObject.iLastPrimitives.get( iPrimState, -1 )     # use the last correct entry - earlier ones could be full
+    if i == -1:
+        #we didn't find it, so add a new one
+        i = iPrimitiveAppend( subObject, iPrimState )
     return i
 
 
 #####################################
+# table of values where each value is stored only once
+# values within tolerance of each other ( on every component ) are treated as equal
+# lookups use a spatial hash, the grid cells are twice the tolerance in size,
+# so any match lies in the value's own cell or in the nearer neighbour along each axis
 class UniqueArray:
 
-    def __init__(self, data, hash, tolerance ):
+    def __init__(self, data, tolerance ):
         self.data = data
-        self.keys = {}
-        self.hash = hash
+        self.keys = {}      # keyed on grid cell, list of indexes into data
         self.tolerance = tolerance
+        self.cellSize = tolerance * 2
 
     def __getitem__(self, i):
         return self.data[i]
@@ -1096,71 +1133,161 @@ class UniqueArray:
                 return False
         return True
 
-    def Key( self, value ):
-        key = 0.0
-        for v in value:
-            key += v
-        return round(key,self.hash)
+    def Find( self, value, key ):
+        for index in self.keys.get( key, () ):
+            if self.Match( value, self.data[index] ):
+                return index
+        return -1
 
     def IndexOf( self, value ):
-        key = self.Key( value )
-        index = self.keys.get(key,-1)
-        while index != -1:
-            storedValue = self.data[index]
-            if self.Match( value, storedValue):
-                return index
-            key += .9  # in case of a hash collision, we advance the key this amount
-            index = self.keys.get(key,-1)
-        # Performance improvement, live with some duplicate values to speed up export
-        global FastExport
-        if FastExport:
-            if len( self.keys ) > 4000:
-                self.keys.clear()
+        cell = []
+        nearCell = []   # the neighbouring cell closest to value, along each axis
+        for v in value:
+            q = v / self.cellSize
+            c = floor( q )
+            cell.append( c )
+            nearCell.append( c - 1 if q - c < 0.5 else c + 1 )
+        key = tuple( cell )
+        index = self.Find( value, key )
+        if index != -1:
+            return index
+        for neighbour in product( *zip( cell, nearCell ) ):
+            if neighbour != key:
+                index = self.Find( value, neighbour )
+                if index != -1:
+                    return index
         # we didn't find it so add it
         index = len( self.data )
         self.data.append( value )
-        self.keys[ key ] = index
+        self.keys.setdefault( key, [] ).append( index )
         return index
 
 #####################################
-def iVertexAdd( iPoint, iNormal, iUVs, vertexSet, color1, color2 ):
-
-    # search index to see if a matching vertex exists
-    if iPoint in vertexSet.index:
-        for iVertex in vertexSet.index[iPoint]:
-            vertex = vertexSet.Vertices[iVertex]
-            if vertex.iPoint == iPoint and vertex.iNormal == iNormal and MatchList(vertex.iUVs,iUVs) and vertex.Color1 == color1 and vertex.Color2 == color2 :
-                return iVertex
-
-    #we didnt' find it so add a new one
-    vertex = Vertex()
-    vertex.iPoint = iPoint
-    vertex.iNormal = iNormal
-    vertex.Color1 = color1
-    vertex.Color2 = color2
-    for iUV in iUVs:
-        vertex.iUVs.append( iUV )
-    iVertex = len( vertexSet.Vertices )
-    vertexSet.Vertices.append( vertex )
-
-    #index on iPoint for speedup
-    if not iPoint in vertexSet.index:
-        vertexSet.index[iPoint] = []
-    vertexSet.index[iPoint].append( iVertex )
-
-    return iVertex
-
-#####################################
-def iUVPointAdd( uvPoint ):
+# weld an ( n, d ) array of values in bulk, giving the same result as adding them in order to a UniqueArray
+# returns the unique values, and an array with the index of the unique value for each of the values
+# exact duplicates are merged first, values with no other value near their grid cell are unique,
+# so only the crowded values are matched one at a time, each time they appear
+def WeldValues( values, tolerance ):
+
+    values = numpy.asarray( values, dtype=numpy.float64 )
+    count = len( values )
+    if count == 0:
+        return values, numpy.zeros( 0, dtype=numpy.int64 )
+
+    # merge exact duplicates, keeping the order the values are first seen in
+    order = numpy.lexsort( values.T[::-1] )
+    sortedValues = values[order]
+    startsGroup = numpy.ones( count, dtype=bool )
+    startsGroup[1:] = ( sortedValues[1:] != sortedValues[:-1] ).any( axis=1 )
+    group = numpy.cumsum( startsGroup ) - 1
+    firstSeen = order[startsGroup]      # the sort is stable, so this is each group's first value
+    seenOrder = numpy.argsort( firstSeen, kind='stable' )
+    rank = numpy.empty( len( firstSeen ), dtype=numpy.int64 )
+    rank[seenOrder] = numpy.arange( len( firstSeen ) )
+    distinct = values[ firstSeen[seenOrder] ]
+    inverse = numpy.empty( count, dtype=numpy.int64 )
+    inverse[order] = rank[group]
+
+    # UniqueArray.IndexOf only compares values whose grid cells ( twice the tolerance ) are adjacent,
+    # ie less than four tolerances apart on every axis, every such pair shares a cell in at least one
+    # of the grids eight tolerances in size, shifted by zero or half a cell along each axis
+    # cells are hashed to a single key, a collision only makes more values crowded
+    crowded = numpy.zeros( len( distinct ), dtype=bool )
+    coarseSize = tolerance * 8
+    for shifts in product( ( 0.0, coarseSize / 2 ), repeat=distinct.shape[1] ):
+        cells = numpy.floor( ( distinct + shifts ) / coarseSize ).astype( numpy.int64 )
+        keys = numpy.bitwise_xor.reduce( cells * SpatialHashPrimes[ : cells.shape[1] ], axis=1 )
+        keyOrder = numpy.argsort( keys, kind='stable' )
+        sortedKeys = keys[keyOrder]
+        shared = sortedKeys[1:] == sortedKeys[:-1]
+        crowded[ keyOrder[1:][shared] ] = True
+        crowded[ keyOrder[:-1][shared] ] = True
+
+    # match every crowded value in order, repeats included, as a repeat may find
+    # a unique added since its first appearance before the one that appearance matched
+    isUnique = ~crowded
+    match = inverse.copy()      # index of the distinct value each value welds to
+    crowdedIndexes = numpy.flatnonzero( crowded[inverse] ).tolist()
+    crowdedUniques = UniqueArray( [], tolerance )
+    owners = []     # index of the distinct value that created each crowded unique
+    for i, value in zip( crowdedIndexes, values[crowdedIndexes].tolist() ):
+        index = crowdedUniques.IndexOf( tuple( value ) )
+        if index == len( owners ):
+            owners.append( inverse[i] )
+            isUnique[ inverse[i] ] = True
+        match[i] = owners[index]
+
+    uniqueIndex = numpy.cumsum( isUnique ) - 1
+    return distinct[isUnique], uniqueIndex[match]
+
+SpatialHashPrimes = numpy.array( [ 73856093, 19349663, 83492791, 2971215073 ], dtype=numpy.int64 )
+
+#####################################
+# keyed store that discards the least recently used entries
+# once the total size of its entries exceeds maxSize
+# the most recent entry is always kept, however large
+class LRUCache:
+
+    def __init__( self, maxSize ):
+        self.entries = OrderedDict()    # keyed on cache key, ( value, size ) in order of use
+        self.size = 0
+        self.maxSize = maxSize
+
+    def Get( self, key ):
+        entry = self.entries.get( key )
+        if entry == None:
+            return None
+        self.entries.move_to_end( key )
+        return entry[0]
+
+    def Put( self, key, value, size ):
+        if key in self.entries:
+            self.size -= self.entries.pop( key )[1]
+        self.entries[key] = ( value, size )
+        self.size += size
+        while self.size > self.maxSize and len( self.entries ) > 1:
+            _, oldSize = self.entries.popitem( last=False )[1]
+            self.size -= oldSize
+
+    def Clear( self ):
+        self.entries.clear()
+        self.size = 0
+
+    # remove the entries whose value matches, eg those that are only valid for one shape
+    def Discard( self, match ):
+        for key in [ key for key, entry in self.entries.items() if match( entry[0] ) ]:
+            self.size -= self.entries.pop( key )[1]
+
+#####################################
+# add an ( n,2 ) array of uv points, return a list of their indexes
+def iUVPointsAdd( uvPoints ):
     global UniqueUVPoints
-    MSTSuvPoint =  (uvPoint[0],1-uvPoint[1])
-    return UniqueUVPoints.IndexOf( MSTSuvPoint )
+    if EstimateOnly:
+        return iWeldedValuesAdd( UniqueUVPoints, numpy.stack( ( uvPoints[ :, 0 ], 1 - uvPoints[ :, 1 ].astype( numpy.float64 ) ), axis=1 ) )
+    return [ UniqueUVPoints.IndexOf( ( uv[0],1-uv[1] ) ) for uv in uvPoints.tolist() ]
 
 #####################################
-def iNormalAdd( vector ):
+# add an ( n,3 ) array of normals, return a list of their indexes
+def iNormalsAdd( vectors ):
     global UniqueNormals
-    MSTSvector =  (vector[0],vector[2],vector[1] )
-    return UniqueNormals.IndexOf( MSTSvector )
+    if EstimateOnly:
+        return iWeldedValuesAdd( UniqueNormals, vectors[ :, ( 0,2,1 ) ] )
+    return [ UniqueNormals.IndexOf( ( v[0],v[2],v[1] ) ) for v in vectors.tolist() ]
+
+#####################################
+# add an ( n,d ) array of values to the table of uniqueArray in one batch, return an array of their indexes
+# the values are only welded to each other, as IndexOf does for a mesh once the keys are cleared,
+# and values in the same grid cell are taken to be the same, rather than values within tolerance,
+# the tables are only counted in an estimate, so the faster weld is close enough
+def iWeldedValuesAdd( uniqueArray, values ):
+    values = numpy.asarray( values, dtype=numpy.float64 )
+    cells = numpy.floor( values / uniqueArray.cellSize ).astype( numpy.int64 )
+    _, first, conversion = numpy.unique( cells, axis=0, return_index=True, return_inverse=True )
+    uniqueValues = values[first]
+    conversion = conversion.reshape( -1 )
+    iOffset = len( uniqueArray.data )
+    uniqueArray.data.ExtendArray( uniqueValues )
+    return conversion + iOffset
 
 
 
@@ -1172,52 +1299,31 @@ def SplitSubObject( subObject):
     newSubObject.Flags = subObject.Flags
     newSubObject.Priority = subObject.Priority
     newSubObject.iHierarchy = subObject.iHierarchy
-    for eachVertexSet in subObject.VertexSets:
-        newVertexSet = VertexSet()
-        newSubObject.VertexSets.append( newVertexSet ) #unused vertex sets are purged during write
-    subObject.DistanceLevel.SubObjects.append( newSubObject )
+    AppendSubObject( subObject.DistanceLevel, newSubObject )
     return newSubObject
 
 ########################################
-# find the last subobject that uses the specified flags
-# or return None of none found
-def FindSubObject( distanceLevel, flags, priority, iHierarchy):
+# subobjects that FindSubObject treats as the same
+def SubObjectKey( flags, priority, iHierarchy ):
 
-    # starting at the end, look for one with the needed flags
-    iLast = len( distanceLevel.SubObjects ) - 1
-    while iLast >= 0:
-        subObject = distanceLevel.SubObjects[iLast]
-        if HierarchyOptimization:
-            if subObject.Flags == flags and subObject.Priority == priority and subObject.iHierarchy == iHierarchy:
-                return subObject
-        else:
-            if subObject.Flags == flags and subObject.Priority == priority:
-                return subObject
-        iLast -= 1
+    if HierarchyOptimization:
+        return ( flags, priority, iHierarchy )
+    else:
+        return ( flags, priority )
 
-    return None
+########################################
+# add subObject to the distance level, it becomes the last one with its flags
+def AppendSubObject( distanceLevel, subObject ):
 
+    distanceLevel.SubObjects.append( subObject )
+    distanceLevel.LastSubObjects[ SubObjectKey( subObject.Flags, subObject.Priority, subObject.iHierarchy ) ] = subObject
 
-#####################################
-def ChildOf( ancestor, object ):
-    if object.parent == None:
-        return False
-    if object.parent == ancestor:
-        return True
-    if ChildOf( ancestor, object.parent ):
-        return True
-    return False
+########################################
+# find the last subobject that uses the specified flags
+# or return None of none found
+def FindSubObject( distanceLevel, flags, priority, iHierarchy):
 
-#####################################
-def ConstructMatrix( ancestor, object ):
-    # construct a cumulative transfer matrix from object to ancestor
-    if object == ancestor:
-        return mathutils.Matrix.Translation((0,0,0))
-    if object.parent == None:
-        return object.matrix_local
-    if object.parent == ancestor:
-        return object.matrix_local
-    return ConstructMatrix( ancestor, object.parent ) @ object.matrix_local
+    return distanceLevel.LastSubObjects.get( SubObjectKey( flags, priority, iHierarchy ) )
 
 
 #####################################
@@ -1241,14 +1347,22 @@ def IsAnimated( nodeObject ):
                 return True
     return False
 
+#####################################
+# map each object to the set of names of the LOD collections it is in, including via child collections
+# built once per export so membership tests don't rescan the collections
+def BuildLodMembership( lodCollections ):
+
+    membership = {}
+    for eachLodCollection in lodCollections:
+        for eachObject in eachLodCollection.all_objects:
+            membership.setdefault( eachObject, set() ).add( eachLodCollection.name )
+    return membership
+
 #####################################
 def InLodCollections( nodeObject ):
 
-    global LodCollections
-    for eachLodCollection in LodCollections:
-        if nodeObject in eachLodCollection.all_objects.values():
-            return True
-    return False
+    global LodMembership
+    return nodeObject in LodMembership
 
 #####################################
 def IsRetained( nodeObject ):
@@ -1261,24 +1375,36 @@ def IsRetained( nodeObject ):
 
 
 #####################################
-def MergeChildren( nodeObject, iParent ):
+# nodeMatrix is the cumulative transfer matrix from nodeObject to the retained node at iParent
+# or None when nodeObject is that node, the children's matrices are built on it top down
+def MergeChildren( nodeObject, iParent, nodeMatrix ):
 
     for eachNode in nodeObject.children:
+        if nodeMatrix == None:
+            matrix = eachNode.matrix_local
+        else:
+            matrix = nodeMatrix @ eachNode.matrix_local
         if IsRetained( eachNode ):
-            BuildHierarchyFrom( eachNode, iParent )
+            BuildHierarchyFrom( eachNode, iParent, matrix )
         else:
-            MergeChildren( eachNode, iParent )
+            MergeChildren( eachNode, iParent, matrix )
             hierarchyObjects[iParent].append( eachNode )
+            hierarchyMatrices[iParent].append( matrix )
 
 #####################################
-def BuildHierarchyFrom( nodeObject, iParent ):
+# parentMatrix is the cumulative transfer matrix from nodeObject to the retained node at iParent
+def BuildHierarchyFrom( nodeObject, iParent, parentMatrix ):
     global hierarchy
     global hierarchyObjects
+    global hierarchyMatrices
+    global hierarchyParentMatrices
 
     index = len(hierarchy)
     hierarchy.append( iParent )
     hierarchyObjects.append( [ nodeObject ] )
-    MergeChildren( nodeObject, index )
+    hierarchyMatrices.append( [ mathutils.Matrix.Translation((0,0,0)) ] )
+    hierarchyParentMatrices.append( parentMatrix )
+    MergeChildren( nodeObject, index, None )
 
 
 
@@ -1303,8 +1429,7 @@ def CreateMSTSMatrices():
         mstsMatrix = MSTSMatrix()
         mstsMatrix.Label = MSTSName(thisNodeObject.name)
         if hierarchy[i] != -1:
-            parentNodeObject = hierarchyObjects[hierarchy[i]][0]
-            blenderMatrix = ConstructMatrix( parentNodeObject, thisNodeObject )
+            blenderMatrix = hierarchyParentMatrices[i]
 
             mstsMatrix.M11 = blenderMatrix[0][0]  # note coordinate conversion and use of new 2.62 indexing
             mstsMatrix.M13 = blenderMatrix[1][0]
@@ -1325,36 +1450,143 @@ def CreateMSTSMatrices():
         ExportShape.Matrices.append( mstsMatrix )
 
 
+#####################################
+# convert a mathutils Matrix to a float32 numpy array
+def MatrixArray( matrix ):
+
+    return numpy.array( [ list( eachRow ) for eachRow in matrix ], dtype=numpy.float32 )
+
+
+#####################################
+# a hashable copy of a mathutils Matrix, for use in cache keys
+def MatrixKey( matrix ):
+
+    return tuple( v for eachRow in matrix for v in eachRow )
+
+
+#####################################
+# transform an ( n,3 ) array of coordinates by each of the 4x4 matrices in one batch
+# returns a ( matrices, n, 3 ) array, still in blender coordinates
+# the arithmetic is float32 and summed in the same order as mathutils,
+# so each point matches matrix @ v.co
+def TransformPoints( coordinates, matrices ):
+
+    m = numpy.stack( [ MatrixArray( eachMatrix ) for eachMatrix in matrices ] )[ :, None, :3, : ]
+    c = coordinates[ None, :, :, None ]
+    return c[:,:,0] * m[...,0] + c[:,:,1] * m[...,1] + c[:,:,2] * m[...,2] + m[...,3]
+
+
+#####################################
+# transform an ( ..., 3 ) array of direction vectors by the 3x3 part of matrix
+# float32, summed in the same order as mathutils, matching matrix.to_3x3() @ v
+def TransformVectors( vectors, matrix ):
+
+    m = MatrixArray( matrix )[ :3, :3 ]
+    return vectors[...,0:1] * m[:,0] + vectors[...,1:2] * m[:,1] + vectors[...,2:3] * m[:,2]
+
+
+#####################################
+# normalize an ( ..., 3 ) array of vectors
+# follows the float32 steps of mathutils Vector.normalize(), zero length vectors become zero
+def NormalizeVectors( vectors ):
+
+    squares = ( vectors * vectors ).astype( numpy.float64 )
+    lengthSquared = squares[...,2] + squares[...,1] + squares[...,0]
+    valid = lengthSquared > 1.0e-35
+    length = numpy.sqrt( numpy.where( valid, lengthSquared, 1.0 ) ).astype( numpy.float32 )
+    scale = numpy.where( valid, numpy.float32( 1.0 ) / length, numpy.float32( 0.0 ) )
+    return vectors * scale[...,None]
+
+
+#####################################
+# calculate the normals of every triangle corner of the mesh in one batch
+# normalOverride specifies the special handling of normals, eg Normals.Face .Out .Up .OutX .Fillet
+#   Normals.Face is overridden per triangle by the smooth flag
+# returns ( cornerNormals, faceNormals ) in blender coordinates, transformed by offsetMatrix
+#   cornerNormals is ( triangles, 3, 3 ), one normal per triangle corner,
+#   or None for Normals.Up where every corner uses ( 0,0,1 )
+#   faceNormals is ( triangles, 3 ), used by MSTS for culling purposes
+def CalculateMeshNormals( meshArrays, normalOverride, offsetMatrix ):
+
+    triangleCount = len( meshArrays.triangleVertices )
+
+    faceNormals = NormalizeVectors( TransformVectors( meshArrays.triangleNormals, offsetMatrix ) )
+
+    if normalOverride == Normals.Up:
+        return None, faceNormals
+
+    if normalOverride == Normals.Out:
+        # use tree type tangent shading ( normals radiate out from center )
+        cornerNormals = meshArrays.coordinates[ meshArrays.triangleVertices ]
+        return NormalizeVectors( TransformVectors( cornerNormals, offsetMatrix ) ), faceNormals
+
+    if normalOverride == Normals.OutX:
+        # radiate out from below Y axis ( ie LPSTrack100m side vegetation )
+        normal = offsetMatrix.translation
+        normal = Vector( (normal.x-4, 0, normal.z + 12) )
+        normal.normalize()
+        cornerNormals = numpy.empty( ( triangleCount, 3, 3 ), dtype=numpy.float32 )
+        cornerNormals[:] = tuple( normal )
+        return cornerNormals, faceNormals
+
+    # smooth normals are read per corner, supporting smooth/custom normals across Blender versions
+    smoothNormals = meshArrays.cornerNormals[ meshArrays.triangleLoops ]
+
+    if normalOverride == Normals.Fillet:
+        # preprocess normals for filleted appearance
+        # verts in a flat face will use the face normal
+        # verts in a smoothed face use the normal of the adjacent flat face ( the last one when several )
+        # Do not assign to mesh.vertices[i].normal: computed mesh normals are not
+        # writable/reliable across newer Blender versions. Keep exporter-only
+        # overrides instead.
+        flat = numpy.flatnonzero( ~meshArrays.triangleSmooth )[::-1]
+        iVerts, first = numpy.unique( meshArrays.triangleVertices[ flat ].reshape( -1 ), return_index=True )
+        overridden = numpy.zeros( len( meshArrays.coordinates ), dtype=bool )
+        overrides = numpy.zeros( ( len( meshArrays.coordinates ), 3 ), dtype=numpy.float32 )
+        overridden[ iVerts ] = True
+        overrides[ iVerts ] = meshArrays.triangleNormals[ flat[ first // 3 ] ]
+        cornerOverridden = overridden[ meshArrays.triangleVertices ]
+        smoothNormals = numpy.where( cornerOverridden[...,None], overrides[ meshArrays.triangleVertices ], smoothNormals )
+
+    smoothNormals = NormalizeVectors( TransformVectors( smoothNormals, offsetMatrix ) )
+
+    # flat shading uses the face normal, per face override for smooth normals
+    return numpy.where( meshArrays.triangleSmooth[:,None,None], smoothNormals, faceNormals[:,None,:] ), faceNormals
+
+
 #####################################
 # create an msts point for each vertex in the blender mesh
+# and extend the bounds with the same vertices in world coordinates via boundsMatrix
+# both transforms are done in a single batch
 # return an offset into the shape's point table
-def AddMeshVertexPoints( mesh, offsetMatrix ):
+def AddMeshVertexPoints( meshArrays, offsetMatrix, boundsMatrix ):
+
+    points, boundsPoints = TransformPoints( meshArrays.coordinates, ( offsetMatrix, boundsMatrix ) )
 
     iPointOffset = len( ExportShape.Points )
-    for v in mesh.vertices:
-        blenderPoint = offsetMatrix @ v.co
-        mstspoint = (blenderPoint[0],blenderPoint[2],blenderPoint[1] )
-        ExportShape.Points.append( mstspoint )
+    ExportShape.Points.ExtendArray( points[ :, ( 0,2,1 ) ] )
+
+    ExtendBoundsForPoints( boundsPoints )
 
     return iPointOffset
 
 
 #####################################
 # update the global lowerBound and upperBound vectors
-# transform its points into world coordinates via the offsetMatrix
-def ExtendBoundsForMesh( mesh, offsetMatrix ):
+# points is an ( n,3 ) array already in world coordinates
+def ExtendBoundsForPoints( points ):
 
     global UpperBound
     global LowerBound
 
-    for eachVertex in mesh.vertices:
-        v = offsetMatrix @ eachVertex.co
-        if v.x > UpperBound.x:  UpperBound.x = v.x
-        if v.y > UpperBound.y:  UpperBound.y = v.y
-        if v.z > UpperBound.z:  UpperBound.z = v.z
-        if v.x < LowerBound.x:  LowerBound.x = v.x
-        if v.y < LowerBound.y:  LowerBound.y = v.y
-        if v.z < LowerBound.z:  LowerBound.z = v.z
+    if len( points ) == 0:
+        return
+
+    upper = points.max( axis=0 ).tolist()
+    lower = points.min( axis=0 ).tolist()
+    for i in range( 0, 3 ):
+        if upper[i] > UpperBound[i]:  UpperBound[i] = upper[i]
+        if lower[i] < LowerBound[i]:  LowerBound[i] = lower[i]
 
 
 
@@ -1365,110 +1597,225 @@ def HasGeometry( object ):
     return object.type in ['MESH']  # TODO add support for 'CURVE','SURFACE','META','FONT'
 
 #####################################
-# return a per-corner smooth normal in a way that works across Blender versions
-# Blender 4.1+ removed parts of the old split normal workflow; corner_normals is
-# the preferred source when present, while older versions can still use triangle
-# split_normals.
-def GetTriangleSmoothNormal( mesh, blTriangle, triangleVertexIndex ):
+# bulk copy of the evaluated mesh data used by the exporter
+# each attribute is pulled from Blender with a single foreach_get call
+# instead of one RNA access per triangle corner
+class MeshArrays:
+
+    def __init__( self, mesh ):
+
+        vertexCount = len( mesh.vertices )
+        loopCount = len( mesh.loops )
+        triangleCount = len( mesh.loop_triangles )
 
-    iLoop = blTriangle.loops[triangleVertexIndex]
+        self.coordinates = ForeachGet( mesh.vertices, 'co', vertexCount, 3, numpy.float32 )
+        self.loopVertices = ForeachGet( mesh.loops, 'vertex_index', loopCount, 1, numpy.int32 )
 
-    if hasattr(mesh, "corner_normals"):
-        cornerNormal = mesh.corner_normals[iLoop]
-        vector = getattr(cornerNormal, "vector", cornerNormal)
-        return mathutils.Vector(vector)
+        self.triangleVertices = ForeachGet( mesh.loop_triangles, 'vertices', triangleCount, 3, numpy.int32 )
+        self.triangleLoops = ForeachGet( mesh.loop_triangles, 'loops', triangleCount, 3, numpy.int32 )
+        self.triangleNormals = ForeachGet( mesh.loop_triangles, 'normal', triangleCount, 3, numpy.float32 )
+        self.triangleMaterials = ForeachGet( mesh.loop_triangles, 'material_index', triangleCount, 1, numpy.int32 )
+        self.triangleSmooth = ForeachGet( mesh.loop_triangles, 'use_smooth', triangleCount, 1, bool )
 
-    if hasattr(blTriangle, "split_normals"):
-        return mathutils.Vector(blTriangle.split_normals[triangleVertexIndex])
+        # per-corner smooth normals in a way that works across Blender versions
+        # Blender 4.1+ removed parts of the old split normal workflow; corner_normals is
+        # the preferred source when present, while older versions can still use the
+        # split normals stored on the loops by calc_normals_split()
+        if hasattr( mesh, "corner_normals" ):
+            self.cornerNormals = ForeachGet( mesh.corner_normals, 'vector', loopCount, 3, numpy.float32 )
+        elif hasattr( mesh, "calc_normals_split" ):
+            self.cornerNormals = ForeachGet( mesh.loops, 'normal', loopCount, 3, numpy.float32 )
+        else:
+            vertexNormals = ForeachGet( mesh.vertices, 'normal', vertexCount, 3, numpy.float32 )
+            self.cornerNormals = vertexNormals[ self.loopVertices ]
+
+        self.uvs = {}   # keyed on uv layer name
+        for eachLayer in mesh.uv_layers:
+            self.uvs[ eachLayer.name ] = ForeachGet( eachLayer.data, 'uv', loopCount, 2, numpy.float32 )
 
-    return mathutils.Vector(mesh.vertices[blTriangle.vertices[triangleVertexIndex]].normal)
+        self.materials = list( mesh.materials )
 
 
 #####################################
-# adds to a sub_object in this distance_level
-# iPointOffset informs the difference between the blender vertex index and the msts vertex index
-# normal specifies an override to the blender supplied normal, eg Normals.Face .Out .Up .Smooth etc
-# tranform the mesh points by relativeMatrix
-# apply the normalOverrides
-# generate triangle lists
-def AddTriangleToSubObject( mesh, mstsMaterial, blTriangle , windingOrder, offsetMatrix, iPointOffset ):
+# read one attribute of every element in a Blender collection into a numpy array
+# width is the number of values per element, eg 3 for a coordinate
+def ForeachGet( collection, attribute, count, width, dtype ):
+
+    values = numpy.empty( count * width, dtype=dtype )
+    if count > 0:
+        collection.foreach_get( attribute, values )
+    if width > 1:
+        values.shape = ( count, width )
+    return values
+
+
+#####################################
+# adds a batch of triangles that use mstsMaterial to its sub_object
+# corner data is in winding order, one row per triangle
+#   iPoints and iNormals are ( triangles, 3 ) arrays
+#   iUVs is a ( triangles, 3, uv layers ) array
+#   iFaceNormals is a ( triangles ) array of face normals ( used by MSTS for culling purposes )
+# corners with the same point, normal and uvs are welded into one vertex, in bulk
+# starts a new sub_object or primitive whenever the MaxVerticesPerSubObject or MaxVerticesPerPrimitive limits are reached
+def AddTrianglesToSubObject( mstsMaterial, iPoints, iNormals, iUVs, iFaceNormals ):
 
     color1 = 0xFFFFFFFF   # vertex colors ( when vertex color layer not present )
     color2 = 0xFF000000
 
-    normalOverride = mstsMaterial.normalOverride
-    if normalOverride == Normals.Face:         # if we didn't specify a special normal mesh property
-        if blTriangle.use_smooth:         # Per face override for smooth normals
-            normalOverride = Normals.Smooth
+    triangleCount = len( iPoints )
+    cornerKeys = numpy.concatenate( ( iPoints[...,None], iNormals[...,None], iUVs ), axis=2 ).reshape( triangleCount * 3, -1 ).astype( numpy.int32 )
+
+    start = 0
+    while start < triangleCount:
+
+        UpdateProgress()
+
+        subObject = mstsMaterial.subObject
+        vertexSet = subObject.GetVertexSet( mstsMaterial.iVertexState )
+
+        end = min( start + VertexWeldBatch, triangleCount )
+        keys = cornerKeys[ start*3 : end*3 ]
+
+        # find the distinct vertices, and any that are already in the vertex set
+        uniqueKeys, first, inverse = numpy.unique( keys, axis=0, return_index=True, return_inverse=True )
+        inverse = inverse.reshape( -1 )
+        iVertices = numpy.full( len( uniqueKeys ), -1, dtype=numpy.int64 )
+        if len( vertexSet ) > 0:
+            uniqueKeyBytes = VertexKeys( uniqueKeys )
+            for u in range( 0, len( uniqueKeyBytes ) ):
+                iVertices[u] = vertexSet.index.get( uniqueKeyBytes[u], -1 )
+
+        # new vertices are numbered in the order the corners first use them
+        newUniques = numpy.flatnonzero( iVertices == -1 )
+        newUniques = newUniques[ numpy.argsort( first[newUniques], kind='stable' ) ]
+        newPerTriangle = numpy.zeros( len( keys ), dtype=numpy.int64 )
+        newPerTriangle[ first[newUniques] ] = 1
+        newPerTriangle = newPerTriangle.reshape( -1, 3 ).sum( axis=1 )
+        newBefore = numpy.cumsum( newPerTriangle ) - newPerTriangle
+
+        # check where the subobject becomes full
+        full = numpy.flatnonzero( subObject.VertexCount + newBefore + 3 > MaxVerticesPerSubObject )
+        count = int( full[0] ) if len( full ) > 0 else end - start
+
+        if count == 0:
+            # subObject is full so start a new one
+            subObject = SplitSubObject( subObject)
+            mstsMaterial.iPrimitive = iPrimitiveAdd( subObject, mstsMaterial.iPrimState )
+            mstsMaterial.subObject = subObject
+            continue
+
+        # add the new vertices used by the first count triangles
+        created = newUniques[ : numpy.searchsorted( first[newUniques], count * 3 ) ]
+        iVertices[ created ] = numpy.arange( len( vertexSet ), len( vertexSet ) + len( created ) )
+        createdKeys = uniqueKeys[created]
+        vertexSet.index.update( zip( VertexKeys( createdKeys ), iVertices[created].tolist() ) )
+        vertexSet.AddVertices( createdKeys, color1, color2 )
+        subObject.VertexCount += len( created )
+
+        mstsTriangles = iVertices[ inverse[ : count * 3 ] ].reshape( -1, 3 )
+        AddTrianglesToPrimitives( mstsMaterial, count, mstsTriangles, iFaceNormals[ start : start + count ] )
+        start += count
+
+
+#####################################
+# for EstimateOnly, count the vertices, triangles and primitives that AddTrianglesToSubObject would add
+# without building the vertex set or the triangle lists
+# the distinct corners are numbered once, and each is counted the first time it is used in a sub_object,
+# corners matching a vertex added by another mesh or material aren't welded to it, so may be counted twice
+def CountTrianglesInSubObject( mstsMaterial, iPoints, iNormals, iUVs ):
+
+    triangleCount = len( iPoints )
+    cornerKeys = numpy.concatenate( ( iPoints[...,None], iNormals[...,None], iUVs ), axis=2 ).reshape( triangleCount * 3, -1 ).astype( numpy.int32 )
+    uniqueKeys, cornerIds = numpy.unique( cornerKeys, axis=0, return_inverse=True )
+    cornerIds = cornerIds.reshape( -1 )
+    counted = numpy.full( len( uniqueKeys ), -1, dtype=numpy.int64 )    # the sub_object each distinct corner was last counted in
+    iSubObject = 0      # numbered from 0 for this batch of triangles
+
+    start = 0
+    while start < triangleCount:
+
+        UpdateProgress()
+
+        subObject = mstsMaterial.subObject
+
+        end = min( start + VertexWeldBatch, triangleCount )
+        ids = cornerIds[ start*3 : end*3 ]
+
+        # the corners that are the first use of a vertex in the sub_object
+        first = numpy.unique( ids, return_index=True )[1]
+        first = numpy.sort( first[ counted[ ids[first] ] != iSubObject ] )
+        newPerTriangle = numpy.zeros( len( ids ), dtype=numpy.int64 )
+        newPerTriangle[first] = 1
+        newPerTriangle = newPerTriangle.reshape( -1, 3 ).sum( axis=1 )
+        newBefore = numpy.cumsum( newPerTriangle ) - newPerTriangle
+
+        # check where the subobject becomes full
+        full = numpy.flatnonzero( subObject.VertexCount + newBefore + 3 > MaxVerticesPerSubObject )
+        count = int( full[0] ) if len( full ) > 0 else end - start
+
+        if count == 0:
+            # subObject is full so start a new one
+            subObject = SplitSubObject( subObject)
+            mstsMaterial.iPrimitive = iPrimitiveAdd( subObject, mstsMaterial.iPrimState )
+            mstsMaterial.subObject = subObject
+            iSubObject += 1
+            continue
+
+        created = first[ : numpy.searchsorted( first, count * 3 ) ]
+        counted[ ids[created] ] = iSubObject
+        subObject.VertexCount += len( created )
+        subObject.VertexSetCounts[ mstsMaterial.iVertexState ] = subObject.VertexSetCounts.get( mstsMaterial.iVertexState, 0 ) + len( created )
+
+        AddTrianglesToPrimitives( mstsMaterial, count, None, None )
+        start += count
+
+
+#####################################
+# the vertex set index keys for rows of ( iPoint, iNormal, iUVs.. )
+# packed as bytes, which take much less memory than tuples
+def VertexKeys( keys ):
+
+    keys = numpy.ascontiguousarray( keys, dtype=numpy.int32 )
+    data = keys.tobytes()
+    rowSize = keys.itemsize * keys.shape[1]
+    return [ data[ i : i + rowSize ] for i in range( 0, len( data ), rowSize ) ]
+
+
+#####################################
+# append triangles to the material's current primitive, starting new primitives as they fill
+# mstsTriangles is a ( triangles, 3 ) array of indexes into the vertex set, iFaceNormals a ( triangles ) array
+# or both are None when the triangles are only counted, see CountTrianglesInSubObject
+def AddTrianglesToPrimitives( mstsMaterial, triangleCount, mstsTriangles, iFaceNormals ):
 
     subObject = mstsMaterial.subObject
-    vertexSet = subObject.VertexSets[mstsMaterial.iVertexState]
-
-    iPrimitive = mstsMaterial.iPrimitive
-    primitive = subObject.Primitives[iPrimitive]
-
-    for indexList in windingOrder:
-        mstsTriangle = []
-        for i in indexList:
-            iblVert = blTriangle.vertices[i]
-
-            iLoop = blTriangle.loops[i]
-
-            iUVs = []
-            for eachLayer in mstsMaterial.uv_layers:
-                bluv = eachLayer.data[iLoop].uv
-                iUV = iUVPointAdd( bluv )
-                iUVs.append(iUV)
-
-            if normalOverride == Normals.Out:
-                # use tree type tangent shading ( normals radiate out from center )
-                normal = mesh.vertices[iblVert].co
-                normal = offsetMatrix.to_3x3() @ normal
-                normal.normalize()
-            elif normalOverride == Normals.Up:
-                normal = ( 0,0,1 )
-            elif normalOverride == Normals.Smooth:
-                # support smooth/custom normals across Blender versions
-                normal = mstsMaterial.normalOverridesByVertex.get(iblVert)
-                if normal == None:
-                    normal = GetTriangleSmoothNormal(mesh, blTriangle, i)
-                normal = offsetMatrix.to_3x3() @ normal
-                normal.normalize()
-            elif normalOverride == Normals.OutX:
-                # radiate out from below Y axis ( ie LPSTrack100m side vegetation )
-                normal = offsetMatrix.translation
-                normal = Vector( (normal.x-4, 0, normal.z + 12) )
-                normal.normalize()
-            else:
-                # flat shading uses the face normal
-                normal = blTriangle.normal
-                normal = offsetMatrix.to_3x3() @ normal
-                normal.normalize()
+    maxTriangles = MaxVerticesPerPrimitive // 3
 
-            iNormal = iNormalAdd( normal )
+    done = 0
+    while done < triangleCount:
 
-            iPoint = iblVert + iPointOffset
-            if iPoint >= len( ExportShape.Points ):
-                raise Exception( 'PROGRAM ERROR:  iPoint out of range' )
+        primitive = subObject.Primitives[ mstsMaterial.iPrimitive ]
 
-            mstsTriangle.append(  iVertexAdd( iPoint, iNormal, iUVs, vertexSet, color1, color2) )
+        if primitive.TriangleCount >= maxTriangles:
+            # primitive is full so start a new one
+            mstsMaterial.iPrimitive = iPrimitiveAppend( subObject, mstsMaterial.iPrimState )
+            continue
 
         # Console output, inform new draw call started
-        if len( primitive.Triangles ) == 0:
-            sequence = mstsMaterial.subObject.sequence
+        if primitive.TriangleCount == 0:
             if len( mstsMaterial.iTextures) > 0:
                 texture = ExportShape.Textures[mstsMaterial.iTextures[0]]
                 filename = ExportShape.Images[texture.iImage]
             else:
                 filename = ''
-            # DEBUG print( "                           SubObject ",sequence," Draw ", filename, " ", mstsMaterial.blMaterial.msts.Transparency, " ",mstsMaterial.blMaterial.msts.Lighting, " MipBias=",mstsMaterial.blMaterial.msts.MipMapLODBias )
             print( "                              Draw ", filename, " ", mstsMaterial.blMaterial.msts.Transparency, " ",mstsMaterial.blMaterial.msts.Lighting, " MipBias=",mstsMaterial.blMaterial.msts.MipMapLODBias )
 
-        primitive.Triangles.append( mstsTriangle )
-        # add a face normal ( used by MSTS for culling purposes )
-        normal =  offsetMatrix.to_3x3() @ blTriangle.normal
-        normal.normalize()
-        primitive.iNormals.append( iNormalAdd( normal ) )
+        count = min( maxTriangles - primitive.TriangleCount, triangleCount - done )
+        if mstsTriangles is None:
+            primitive.TriangleCount += count
+        else:
+            primitive.AddTriangles( mstsTriangles[ done : done + count ], iFaceNormals[ done : done + count ] )
+        subObject.TriangleCount += count
+        done += count
 
 
 # build one for each material in the mesh
@@ -1479,8 +1826,6 @@ class MSTSMaterialDetail:
         self.flags = '00000400 -1 -1 000001d2 000001c4'
         self.priority = 0
         self.uv_layers = []
-        self.normalOverride = Normals.Face
-        self.normalOverridesByVertex = {}
         self.subObject = None
         self.iTextures = []
         self.uvops = []
@@ -1498,29 +1843,98 @@ class MSTSMaterialDetail:
         self.blMaterial = None   # corresponding Blender material
 
 
-def GetMSTSMaterialDetails( distanceLevel, mesh, blMaterial, normalOverride, normalOverridesByVertex, iHierarchy, objectName):
+#####################################
+# the settings of a blender material that are the same in every shape
+# resolved once per export, and shared by the shapes of all the root collections, see ExportShapeFiles
+class MSTSMaterialSettings:
 
-    mstsMaterial = MSTSMaterialDetail()
+    def __init__(self ):
 
-    mstsMaterial.blMaterial = blMaterial
+        self.flags = '00000400 -1 -1 000001d2 000001c4'
+        self.priority = 0
+        self.imageName = None
+        self.mipMapLODBias = 0
+        self.vertexLight = LightingOptions[ 'NORMAL' ]
+        self.alphaTestMode = 0
+        self.shaderName = 'TexDiff'
 
-    mstsMaterial.iHierarchy = iHierarchy
 
-    mstsMaterial.normalOverride = normalOverride
-    mstsMaterial.normalOverridesByVertex = normalOverridesByVertex
+def GetMSTSMaterialSettings( blMaterial ):
+
+    key = blMaterial.as_pointer()
+    settings = MaterialSettings.get( key )
+    if settings != None:
+        return settings
+
+    settings = MSTSMaterialSettings()
+    MaterialSettings[key] = settings
 
     if blMaterial.msts.Transparency == 'ALPHA':
-        mstsMaterial.flags = '00000400 -1 -1 000001d2 000001c4'
-        mstsMaterial.priority = 1
+        settings.flags = '00000400 -1 -1 000001d2 000001c4'
+        settings.priority = 1
     elif blMaterial.msts.Transparency == 'ALPHA_SORT':
-        mstsMaterial.flags = '00000500 0 0 000001d2 000001c4'
-        mstsMaterial.priority = 2
+        settings.flags = '00000500 0 0 000001d2 000001c4'
+        settings.priority = 2
     if blMaterial.msts.Lighting.startswith( 'SPECULAR'):
         # clear bit 10
         # eg  00000500 become 00000100 and 0000400 becomes  00000000
-        d5 = int(mstsMaterial.flags[5],16)
+        d5 = int(settings.flags[5],16)
         d5 &= 0b1011
-        mstsMaterial.flags = mstsMaterial.flags[0:5]+hex(d5)[2]+mstsMaterial.flags[6:]
+        settings.flags = settings.flags[0:5]+hex(d5)[2]+settings.flags[6:]
+
+    # find image used by material
+    settings.imageName = BaseColorImageFrom( blMaterial ) # may return None
+    settings.mipMapLODBias = blMaterial.msts.MipMapLODBias
+
+    # Set Up Vertex Lighting
+    settings.vertexLight = LightingOptions[ blMaterial.msts.Lighting ]
+
+    if blMaterial.msts.Transparency == 'CLIP':
+        settings.alphaTestMode = 1
+    else:
+        settings.alphaTestMode = 0
+
+    if blMaterial.msts.Lighting == "EMISSIVE":
+        if blMaterial.msts.Transparency == 'OPAQUE':
+            settings.shaderName = 'Tex'
+        else:
+            settings.shaderName = 'BlendATex'
+    else:
+        if blMaterial.msts.Transparency == 'OPAQUE':
+            settings.shaderName = 'TexDiff'
+        else:
+            settings.shaderName = 'BlendATexDiff'
+
+    return settings
+
+
+def GetMSTSMaterialDetails( distanceLevel, meshArrays, blMaterial, iHierarchy, objectName):
+
+    #  this could be improved to look for the uv layer in the node tree
+    #  and in the future handle multiple uvs here
+    if not 'UVMap' in meshArrays.uvs:
+        raise MyException( "Missing UVMap in: " + objectName)
+
+    # each material is resolved once per distance level and hierarchy node,
+    # later meshes only move on to the last subobject and primitive, in case they were split
+    key = ( blMaterial.as_pointer(), distanceLevel, iHierarchy )
+    mstsMaterial = MaterialDetails.get( key )
+    if mstsMaterial != None:
+        mstsMaterial.subObject = FindSubObject( distanceLevel, mstsMaterial.flags, mstsMaterial.priority, iHierarchy )
+        mstsMaterial.iPrimitive = iPrimitiveAdd( mstsMaterial.subObject, mstsMaterial.iPrimState )
+        return mstsMaterial
+
+    settings = GetMSTSMaterialSettings( blMaterial )
+
+    mstsMaterial = MSTSMaterialDetail()
+    MaterialDetails[key] = mstsMaterial
+
+    mstsMaterial.blMaterial = blMaterial
+
+    mstsMaterial.iHierarchy = iHierarchy
+
+    mstsMaterial.flags = settings.flags
+    mstsMaterial.priority = settings.priority
 
     subObject = FindSubObject( distanceLevel, mstsMaterial.flags, mstsMaterial.priority, iHierarchy)
 
@@ -1531,24 +1945,15 @@ def GetMSTSMaterialDetails( distanceLevel, mesh, blMaterial, normalOverride, nor
         subObject.Flags = mstsMaterial.flags
         subObject.Priority = mstsMaterial.priority
         subObject.iHierarchy = mstsMaterial.iHierarchy
-        # every vertex_state needs a matching vertex_set
-        for eachVertexState in ExportShape.VertexStates:    # note, unused vertexsets are purged at during write
-            subObject.VertexSets.append( VertexSet() )
-        distanceLevel.SubObjects.append( subObject )
+        AppendSubObject( distanceLevel, subObject )
 
     mstsMaterial.subObject = subObject
 
-    #  this could be improved to look for the uv layer in the node tree
-    #  and in the future handle multiple uvs here
-    if not 'UVMap' in mesh.uv_layers:
-        raise MyException( "Missing UVMap in: " + objectName)
-    mstsMaterial.uv_layers = [ mesh.uv_layers['UVMap']] #but what about beziers generate map 'Orco'
+    mstsMaterial.uv_layers = [ 'UVMap' ] #but what about beziers generate map 'Orco'
 
 
-    # find image used by material
-    imageName = BaseColorImageFrom( blMaterial ) # may return None
-    mipMapLODBias = blMaterial.msts.MipMapLODBias
-    mstsMaterial.iTextures.append( iTextureAdd( imageName, mipMapLODBias ) )
+    # image used by material
+    mstsMaterial.iTextures.append( iTextureAdd( settings.imageName, settings.mipMapLODBias ) )
     textureAddressMode = 1 # repeat
     # textureAddressMode = 3   # extend edges
     # textureAddressMode = 4   # clamp with border
@@ -1560,23 +1965,10 @@ def GetMSTSMaterialDetails( distanceLevel, mesh, blMaterial, normalOverride, nor
 
     # Set Up Vertex Lighting
     mstsMaterial.vertexFlags = 0
-    mstsMaterial.vertexLight = LightingOptions[ blMaterial.msts.Lighting ]
+    mstsMaterial.vertexLight = settings.vertexLight
 
-    if blMaterial.msts.Transparency == 'CLIP':
-        mstsMaterial.alphaTestMode = 1
-    else:
-        mstsMaterial.alphaTestMode = 0
-
-    if blMaterial.msts.Lighting == "EMISSIVE":
-        if blMaterial.msts.Transparency == 'OPAQUE':
-            mstsMaterial.iShader = iShaderAdd( 'Tex' )
-        else:
-            mstsMaterial.iShader = iShaderAdd( 'BlendATex' )
-    else:
-        if blMaterial.msts.Transparency == 'OPAQUE':
-            mstsMaterial.iShader = iShaderAdd( 'TexDiff' )
-        else:
-            mstsMaterial.iShader = iShaderAdd( 'BlendATexDiff' )
+    mstsMaterial.alphaTestMode = settings.alphaTestMode
+    mstsMaterial.iShader = iShaderAdd( settings.shaderName )
 
 
     mstsMaterial.iLightConfig = iLightConfigAdd( mstsMaterial.uvops )
@@ -1598,9 +1990,10 @@ def GetMSTSMaterialDetails( distanceLevel, mesh, blMaterial, normalOverride, nor
 # apply the normalOverrides
 # transfer all vertex points to msts points
 # generate triangle lists
-def AddMesh( distanceLevel, mesh, iHierarchy, offsetMatrix, normalsProperty, objectName ):
+def AddMesh( distanceLevel, meshArrays, meshKey, iHierarchy, offsetMatrix, normalsProperty, objectName ):
 
-    print( '              triangles = ', len( mesh.loop_triangles ) )
+    triangleCount = len( meshArrays.triangleVertices )
+    print( '              triangles = ', triangleCount )
 
     # determine normal override from the object Properties
     normalOverride = Normals.Face
@@ -1612,45 +2005,81 @@ def AddMesh( distanceLevel, mesh, iHierarchy, offsetMatrix, normalsProperty, obj
         normalOverride = Normals.Fillet
     elif normalsProperty == "OUTX":
         normalOverride = Normals.OutX
-    # evaluate any special handling for normals
-    #   Note: these may be overriden 'per face' in AddFaceToSubObject
-    normalOverridesByVertex = {}
-
-    if normalOverride == Normals.Fillet:
-        # preprocess normals for filleted appearance
-        # verts in a flat face will use the face normal
-        # verts in a smoothed face use the normal of the adjacent flat face
-        # Do not assign to mesh.vertices[i].normal: computed mesh normals are not
-        # writable/reliable across newer Blender versions. Keep exporter-only
-        # overrides instead.
-        for tri in mesh.loop_triangles:
-            if not tri.use_smooth:
-                for iVert in tri.vertices:
-                    normalOverridesByVertex[iVert] = mathutils.Vector(tri.normal)
-        # now handle them like standard smoothed normals
-        normalOverride = Normals.Face
-
-    # for every vertex in the blender mesh, add a corresponding msts point
-    iPointOffset = AddMeshVertexPoints( mesh, offsetMatrix )
-
-    ExtendBoundsForMesh( mesh, offsetMatrix @ hierarchyObjects[iHierarchy][0].matrix_world )
 
     # create msts materials for each mesh material
     mstsMaterials = []
-    for blMaterial in mesh.materials:
+    for blMaterial in meshArrays.materials:
         if blMaterial != None:
-            mstsMaterials.append( GetMSTSMaterialDetails( distanceLevel, mesh, blMaterial, normalOverride, normalOverridesByVertex, iHierarchy, objectName ) )
+            mstsMaterials.append( GetMSTSMaterialDetails( distanceLevel, meshArrays, blMaterial, iHierarchy, objectName ) )
         else:
             raise MyException( "Empty Material on object: " + objectName )
 
+    if len( meshArrays.triangleMaterials ) > 0 and meshArrays.triangleMaterials.max() >= len( mstsMaterials ):
+        raise MyException( "Missing Materials on object: " + objectName )
+
     #if scale is negative, invert winding order of triangles
     scale = offsetMatrix.to_scale()
     sign = scale.x * scale.y * scale.z
     if sign < 0:
-       windingOrder = ( (0,1,2),  ) #inverted
+       windingOrder = (0,1,2) #inverted
     else:
-       windingOrder = ( (0,2,1),  ) #forward
+       windingOrder = (0,2,1) #forward
+
+    uvLayers = []
+    for mstsMaterial in mstsMaterials:
+        for eachLayer in mstsMaterial.uv_layers:
+            if eachLayer not in uvLayers:
+                uvLayers.append( eachLayer )
+
+    # the same mesh at the same place in the hierarchy, ie in another distance level,
+    # reuses its points, normals and uv points
+    placementKey = ( meshKey, MatrixKey( offsetMatrix ), iHierarchy, normalsProperty )
+    placement = MeshCache.Get( placementKey )
+    if placement == None or any( eachLayer not in placement.iTriangleUVs for eachLayer in uvLayers ):
+        boundsMatrix = offsetMatrix @ hierarchyObjects[iHierarchy][0].matrix_world
+        placement = PlaceMesh( meshArrays, offsetMatrix, boundsMatrix, normalOverride, windingOrder, uvLayers )
+        MeshCache.Put( placementKey, placement, triangleCount * 3 )
+
+    iPoints = meshArrays.triangleVertices[ :, windingOrder ] + placement.iPointOffset
+    iTriangleNormals = placement.iTriangleNormals
+
+    # add the triangles of each material in a batch
+    for iMaterial in range( 0, len( mstsMaterials ) ):
+
+        mstsMaterial = mstsMaterials[iMaterial]
+        triangles = numpy.flatnonzero( meshArrays.triangleMaterials == iMaterial )
+        if len( triangles ) == 0:
+            continue
+
+        iUVs = numpy.empty( ( len( triangles ), 3, len( mstsMaterial.uv_layers ) ), dtype=numpy.int64 )
+        for iLayer in range( 0, len( mstsMaterial.uv_layers ) ):
+            iUVs[ :, :, iLayer ] = placement.iTriangleUVs[ mstsMaterial.uv_layers[iLayer] ][triangles]
+
+        if EstimateOnly:
+            CountTrianglesInSubObject( mstsMaterial, iPoints[triangles], iTriangleNormals[ triangles, :3 ], iUVs )
+        else:
+            AddTrianglesToSubObject( mstsMaterial, iPoints[triangles], iTriangleNormals[ triangles, :3 ], iUVs, iTriangleNormals[ triangles, 3 ] )
+
 
+#####################################
+# the shape data produced by one mesh at one place in the hierarchy
+class MeshPlacement:
+
+    def __init__( self ):
+        self.iPointOffset = 0           # index of the mesh's first vertex in the shape's point table
+        self.iTriangleNormals = None    # ( triangles, 4 ) normal indexes, the corners in winding order then the face normal
+        self.iTriangleUVs = {}          # keyed on uv layer name, ( triangles, 3 ) uv point indexes in winding order
+
+
+#####################################
+# add the points, normals and uv points of the mesh to the shape
+# and return their indexes as a MeshPlacement
+def PlaceMesh( meshArrays, offsetMatrix, boundsMatrix, normalOverride, windingOrder, uvLayers ):
+
+    placement = MeshPlacement()
+
+    # for every vertex in the blender mesh, add a corresponding msts point
+    placement.iPointOffset = AddMeshVertexPoints( meshArrays, offsetMatrix, boundsMatrix )
 
     # for speedup, resolve unique points only per mesh
     global UniqueUVPoints
@@ -1658,42 +2087,146 @@ def AddMesh( distanceLevel, mesh, iHierarchy, offsetMatrix, normalsProperty, obj
     UniqueUVPoints.keys.clear()
     UniqueNormals.keys.clear()
 
-    for iTriangle in range( 0, len( mesh.loop_triangles ) ):
+    # evaluate the normals for every triangle corner, plus the face normal
+    # and add them in the order the triangle corners are written
+    cornerNormals, faceNormals = CalculateMeshNormals( meshArrays, normalOverride, offsetMatrix )
+    if cornerNormals is None:
+        triangleNormals = numpy.empty( ( len( faceNormals ), 4, 3 ), dtype=faceNormals.dtype )
+        triangleNormals[ :, :3 ] = ( 0,0,1 )     # up
+        triangleNormals[ :, 3 ] = faceNormals
+    else:
+        triangleNormals = numpy.concatenate( ( cornerNormals[ :, windingOrder ], faceNormals[ :, None ] ), axis=1 )
+    iTriangleNormals = iNormalsAdd( triangleNormals.reshape( -1, 3 ) )
+    placement.iTriangleNormals = numpy.array( iTriangleNormals, dtype=numpy.int64 ).reshape( -1, 4 )
 
-        if iTriangle % 10 == 0:   # reduce the update rate
-            UpdateProgress()
+    loops = meshArrays.triangleLoops[ :, windingOrder ]
+    for eachLayer in uvLayers:
+        uvs = meshArrays.uvs[eachLayer][loops]
+        placement.iTriangleUVs[eachLayer] = numpy.array( iUVPointsAdd( uvs.reshape( -1, 2 ) ), dtype=numpy.int64 ).reshape( -1, 3 )
 
-        blTriangle = mesh.loop_triangles[iTriangle]
+    return placement
 
-        if blTriangle.material_index < len( mstsMaterials ):
-            mstsMaterial = mstsMaterials[ blTriangle.material_index ]
-        else:
-            raise MyException( "Missing Materials on object: " + objectName )
 
-        # check if the subobject is full
-        subObject = mstsMaterial.subObject
-        vertexCount = 0
-        for eachVertexSet in subObject.VertexSets:
-            vertexCount += len( eachVertexSet.Vertices )
+#####################################
+# modifiers whose result depends on the object they are on, or on simulation caches
+ObjectSpecificModifiers = [ 'NODES', 'PARTICLE_SYSTEM', 'PARTICLE_INSTANCE', 'EXPLODE', 'CLOTH', 'SOFT_BODY',
+                            'COLLISION', 'DYNAMIC_PAINT', 'FLUID', 'OCEAN', 'SURFACE' ]
 
-        if vertexCount + 3 > MaxVerticesPerSubObject:
-            # subObject is full so start a new one
-            subObject = SplitSubObject( subObject)
-            mstsMaterial.iPrimitive = iPrimitiveAdd( subObject, mstsMaterial.iPrimState )
-            mstsMaterial.subObject = subObject
+# modifier properties that don't change the evaluated mesh
+ModifierUIProperties = [ 'rna_type', 'name', 'show_expanded', 'show_render', 'show_in_editmode', 'show_on_cage',
+                         'is_active', 'is_override_data', 'use_pin_to_last', 'persistent_uid', 'execution_time', 'select' ]
 
-        # check if the primitive is full
-        iPrimitive = mstsMaterial.iPrimitive
-        primitive = subObject.Primitives[iPrimitive]
+ModifierStructDepth = 4     # structs nested deeper than this in a modifier are treated as object specific
 
-        if len(primitive.Triangles) * 3 + 3 > MaxVerticesPerPrimitive:
-            # primitive is full so start a new one
-            iPrimitive = iPrimitiveAppend( subObject, mstsMaterial.iPrimState )
-            primitive = subObject.Primitives[iPrimitive]
-            mstsMaterial.iPrimitive = iPrimitive
+#####################################
+# return a hashable summary of the modifier's settings
+# or None when its result depends on other objects ( ie armature, boolean, mirror object, hook )
+# or on where the object is ( ie a displace, wave or warp texture in global coordinates )
+def ModifierSignature( modifier ):
 
+    if modifier.type in ObjectSpecificModifiers:
+        return None
 
-        AddTriangleToSubObject( mesh, mstsMaterial, blTriangle, windingOrder, offsetMatrix, iPointOffset )
+    signature = StructSignature( modifier, 0 )
+    if signature == None:
+        return None
+    return ( modifier.type, ) + signature
+
+#####################################
+# return a hashable summary of the properties of struct, a modifier or a struct it owns
+# ( ie the custom profile of a bevel ), or None as for ModifierSignature
+def StructSignature( rnaStruct, depth ):
+
+    if depth > ModifierStructDepth:
+        return None
+
+    signature = []
+    for eachProperty in rnaStruct.bl_rna.properties:
+        if eachProperty.identifier in ModifierUIProperties:
+            continue
+        value = getattr( rnaStruct, eachProperty.identifier )
+        if eachProperty.type == 'POINTER':
+            if isinstance( value, bpy.types.ID ):
+                # any datablock but a material may bring in other geometry, eg a boolean's operand collection
+                if not isinstance( value, bpy.types.Material ):
+                    return None
+                value = value.as_pointer()
+            elif value != None:
+                # each modifier owns its own copy of these, so they are compared by their settings
+                value = StructSignature( value, depth + 1 )
+                if value == None:
+                    return None
+        elif eachProperty.type == 'COLLECTION':
+            items = []
+            for eachItem in value:
+                itemSignature = StructSignature( eachItem, depth + 1 )
+                if itemSignature == None:
+                    return None
+                items.append( itemSignature )
+            value = tuple( items )
+        elif eachProperty.type == 'ENUM' and eachProperty.is_enum_flag:
+            value = tuple( sorted( value ) )
+        elif eachProperty.type == 'ENUM' and value == 'GLOBAL':
+            return None     # eg texture_coords, the texture is mapped by the object's world matrix
+        elif getattr( eachProperty, 'is_array', False ):
+            value = tuple( value )
+        signature.append( value )
+    return tuple( signature )
+
+
+#####################################
+# the cache key for the evaluated mesh of object
+# objects sharing a mesh datablock, materials and an equivalent modifier stack, ie linked duplicates
+# evaluate to the same mesh, so they share one key, otherwise the key is specific to the object
+def MeshKey( object ):
+
+    objectKey = object.as_pointer()
+    if object.show_only_shape_key:
+        return objectKey
+
+    modifiers = []
+    for modifier in object.modifiers:
+        if modifier.show_viewport:
+            signature = ModifierSignature( modifier )
+            if signature == None:
+                return objectKey
+            modifiers.append( signature )
+
+    # materials may be linked to the object rather than the mesh
+    materials = tuple( slot.material.as_pointer() if slot.material != None else 0 for slot in object.material_slots )
+
+    return ( object.data.as_pointer(), tuple( modifiers ), materials )
+
+
+#####################################
+# return the MeshArrays for the evaluated mesh of object
+# the mesh is only evaluated and triangulated once per export for each meshKey
+# ie an object in several distance levels, or linked duplicates and their collection instances
+def GetMeshArrays( object, meshKey ):
+
+    meshArrays = MeshCache.Get( meshKey )
+    if meshArrays != None:
+        return meshArrays
+
+    # Apply Modifiers as PREVIEW
+    #depsgraph = bpy.context.evaluated_depsgraph_get()
+    #ob_to_convert = object.evaluated_get(depsgraph)
+    #Update here for Blender 4.1
+    #mesh = ob_to_convert.to_mesh()
+
+    evaluated_obj, mesh = get_evaluated_mesh(object)
+    try:
+        if hasattr(mesh, "calc_normals_split"):
+            mesh.calc_normals_split()
+
+        mesh.calc_loop_triangles()
+
+        meshArrays = MeshArrays( mesh )
+    finally:
+        release_evaluated_mesh(evaluated_obj)
+
+    MeshCache.Put( meshKey, meshArrays, len( meshArrays.triangleVertices ) * 3 )
+    return meshArrays
 
 
 #####################################
@@ -1731,22 +2264,10 @@ def AddObject( distanceLevel, object, iHierarchy, relativeMatrix ):
             # determine normal override from the object Properties
             normalsProperty = object.data.get( 'NORMALS', '' )
 
-            # Apply Modifiers as PREVIEW
-            #depsgraph = bpy.context.evaluated_depsgraph_get()
-            #ob_to_convert = object.evaluated_get(depsgraph)
-            #Update here for Blender 4.1
-            #mesh = ob_to_convert.to_mesh()
-            
-            evaluated_obj, mesh = get_evaluated_mesh(object)
-            try:
-                if hasattr(mesh, "calc_normals_split"):
-                    mesh.calc_normals_split()
-                
-                mesh.calc_loop_triangles()
+            meshKey = MeshKey( object )
+            meshArrays = GetMeshArrays( object, meshKey )
 
-                AddMesh( distanceLevel, mesh, iHierarchy, relativeMatrix, normalsProperty, object.name )
-            finally:
-                release_evaluated_mesh(evaluated_obj)
+            AddMesh( distanceLevel, meshArrays, meshKey, iHierarchy, relativeMatrix, normalsProperty, object.name )
 
 
 
@@ -1777,6 +2298,7 @@ def AppendDistanceLevel( lodCollection ):
     global ExportShape
     global hierarchy
     global hierarchyObjects
+    global LodMembership
 
     distanceLimit = LodDistanceFromName( lodCollection.name )
 
@@ -1789,10 +2311,10 @@ def AppendDistanceLevel( lodCollection ):
     lodControl.DistanceLevels.append( distanceLevel )
 
     for iHierarchy in range( 0, len( hierarchy ) ):
-        for object in hierarchyObjects[iHierarchy]:
-            if object in lodCollection.all_objects.values():
-                nodeObject = hierarchyObjects[iHierarchy][0]
-                relativeMatrix =  ConstructMatrix( nodeObject, object )
+        for iObject in range( 0, len( hierarchyObjects[iHierarchy] ) ):
+            object = hierarchyObjects[iHierarchy][iObject]
+            if lodCollection.name in LodMembership.get( object, () ):
+                relativeMatrix = hierarchyMatrices[iHierarchy][iObject]
                 AddObject( distanceLevel, object, iHierarchy, relativeMatrix )
 
 
@@ -1801,7 +2323,28 @@ def AppendDistanceLevel( lodCollection ):
     if len( distanceLevel.SubObjects) == 0 or len( distanceLevel.SubObjects[0].Primitives ) == 0:
         print( 'WARNING - empty distance level ',distanceLevel.Selection )
         del lodControl.DistanceLevels[ len( lodControl.DistanceLevels )-1 ]
+    elif ExportShape.SpillFolder != None:
+        # the distance level is complete, so keep it on disk until the shape is written
+        CompactDistanceLevel( distanceLevel )
+        MaterialDetails.clear()     # its entries are only used by this distance level
+        distanceLevel.Spill()
 
+#####################################
+# iterate over every distance level in the shape
+# spilled distance levels are loaded for the duration of the step, and spilled again afterwards
+# unless changed is False, ie they were only read
+def EachDistanceLevel( changed = True ):
+    for eachLODControl in ExportShape.LodControls:
+        for eachDistanceLevel in eachLODControl.DistanceLevels:
+            if eachDistanceLevel.SpillPath == None:
+                yield eachDistanceLevel
+            else:
+                eachDistanceLevel.Load()
+                yield eachDistanceLevel
+                if changed:
+                    eachDistanceLevel.Spill()
+                else:
+                    eachDistanceLevel.Unload()
 
 
 #####################################
@@ -1827,55 +2370,169 @@ def FindBoundingRadius( center ):
 def CompactPoints():
     global ExportShape
 
-    oldPoints = ExportShape.Points
-    ExportShape.Points = []
-    uniquePoints = UniqueArray( ExportShape.Points,3,0.0001 )
-    conversion = []
+    oldPoints = numpy.frombuffer( ExportShape.Points.Values, dtype=numpy.float64 ).reshape( -1, 3 )
+    points, conversion = WeldValues( oldPoints, 0.0001 )
+    ExportShape.Points = PointTable( 3 )
+    ExportShape.Points.ExtendArray( points )
+    conversion = conversion.astype( numpy.int32 )
 
-    for eachPoint in oldPoints:
-       conversion.append( uniquePoints.IndexOf( eachPoint ) )
+    for eachDistanceLevel in EachDistanceLevel():
+        for eachSubObject in eachDistanceLevel.SubObjects:
+            for eachVertexSet in eachSubObject.VertexSets.values():
+                iPoints = numpy.frombuffer( eachVertexSet.iPoints, dtype=numpy.int32 )
+                eachVertexSet.iPoints = array( 'i', conversion[iPoints].tobytes() )
+
+#####################################
+# remove empty primitives, then empty subobjects
+def CompactDistanceLevel( distanceLevel ):
+
+    OKSubObjects = []
+    for eachSubObject in distanceLevel.SubObjects:
+        eachSubObject.Primitives = [ eachPrimitive for eachPrimitive in eachSubObject.Primitives if eachPrimitive.TriangleCount > 0 ]
+        if len( eachSubObject.Primitives ) > 0:
+            OKSubObjects.append( eachSubObject )
+    distanceLevel.SubObjects = OKSubObjects
 
-    for eachLODControl in ExportShape.LodControls:
-        for eachDistanceLevel in eachLODControl.DistanceLevels:
-            for eachSubObject in eachDistanceLevel.SubObjects:
-                for eachVertexSet in eachSubObject.VertexSets:
-                    for eachVertex in eachVertexSet.Vertices:
-                        eachVertex.iPoint = conversion[eachVertex.iPoint]
 
 #####################################
-# remove empty primitives
-def CompactPrimitives( ):
+# return the index of the entry each entry moves to when unreferenced entries are dropped
+# and referenced entries with the same key are merged, -1 for dropped entries
+# and the indexes of the entries that are kept, in their original order
+def CompactTable( keys, referenced ):
 
-    emptyCount = 0
-    for eachLODControl in ExportShape.LodControls:
-        for eachDistanceLevel in eachLODControl.DistanceLevels:
-            for eachSubObject in eachDistanceLevel.SubObjects:
-                OKPrimitives = []
-                for eachPrimitive in eachSubObject.Primitives:
-                    if len( eachPrimitive.Triangles ) > 0:
-                        OKPrimitives.append( eachPrimitive )
-                    else:
-                        emptyCount += 1
-                eachSubObject.Primitives = OKPrimitives
+    conversion = [ -1 ] * len( keys )
+    kept = []
+    keptIndexes = {}    # keyed on entry key, the entry's new index
+    for i in range( 0, len( keys ) ):
+        if referenced[i]:
+            j = keptIndexes.get( keys[i] )
+            if j == None:
+                j = len( kept )
+                keptIndexes[ keys[i] ] = j
+                kept.append( i )
+            conversion[i] = j
+    return kept, conversion
 
-    # DEBUG print ( "Compacting ",emptyCount," Empty Primitives" )
+#####################################
+# as CompactTable, for a PointTable where entries within tolerance are merged
+# referenced is a numpy array of the indexes in use
+def CompactPointTable( table, referenced, tolerance ):
+
+    referenced = numpy.unique( referenced )
+    values = numpy.frombuffer( table.Values, dtype=numpy.float64 ).reshape( -1, table.Width )
+    uniqueValues, uniqueIndex = WeldValues( values[referenced], tolerance )
+    first = numpy.unique( uniqueIndex, return_index=True )[1]   # each unique is created by the first value welded to it
+    conversion = numpy.full( len( table ), -1, dtype=numpy.int32 )
+    conversion[referenced] = uniqueIndex
+    return table.Select( referenced[first] ), conversion
 
 #####################################
-# remove empty subobjects
-def CompactSubObjects( ):
+# apply a numpy conversion array to an array( 'i' ) of indexes
+def RemapIndexes( indexes, conversion ):
 
-    emptyCount = 0
-    for eachLODControl in ExportShape.LodControls:
-        for eachDistanceLevel in eachLODControl.DistanceLevels:
-                OKSubObjects = []
-                for eachSubObject in eachDistanceLevel.SubObjects:
-                    if len( eachSubObject.Primitives ) > 0:
-                        OKSubObjects.append( eachSubObject )
-                    else:
-                        emptyCount += 1
-                eachDistanceLevel.SubObjects = OKSubObjects
+    return array( 'i', conversion[ numpy.frombuffer( indexes, dtype=numpy.int32 ) ].astype( numpy.int32 ).tobytes() )
 
-    # DEBUG print ( "Compacting ",emptyCount," Empty SubObjects" )
+#####################################
+# remove duplicate and unused uv points, normals, colours, light materials, vertex states and prim states
+# and remap all the indexes that refer to them
+def CompactShapeTables( ):
+
+    global ExportShape
+
+    # find what is referenced, starting from the primitives
+    # one distance level at a time, the uv point and normal indexes are gathered without repeats
+    primStates = ExportShape.PrimStates
+    vertexStates = ExportShape.VertexStates
+    primStateUsed = [ False ] * len( primStates )
+    iUVs = []
+    iNormals = []
+    for eachDistanceLevel in EachDistanceLevel( False ):
+        levelUVs = []
+        levelNormals = []
+        for eachSubObject in eachDistanceLevel.SubObjects:
+            for eachPrimitive in eachSubObject.Primitives:
+                primStateUsed[ eachPrimitive.iPrimState ] = True
+                levelNormals.append( numpy.frombuffer( eachPrimitive.iNormals, dtype=numpy.int32 ) )
+            for eachVertexSet in eachSubObject.VertexSets.values():
+                levelUVs.append( numpy.frombuffer( eachVertexSet.iUVs, dtype=numpy.int32 ) )
+                levelNormals.append( numpy.frombuffer( eachVertexSet.iNormals, dtype=numpy.int32 ) )
+        if len( levelUVs ) > 0:
+            iUVs.append( numpy.unique( numpy.concatenate( levelUVs ) ) )
+            iNormals.append( numpy.unique( numpy.concatenate( levelNormals ) ) )
+    vertexStateUsed = [ False ] * len( vertexStates )
+    for i in range( 0, len( primStates ) ):
+        if primStateUsed[i]:
+            vertexStateUsed[ primStates[i].iVertexState ] = True
+    lightMaterialUsed = [ False ] * len( ExportShape.LightMaterials )
+    for i in range( 0, len( vertexStates ) ):
+        if vertexStateUsed[i] and vertexStates[i].iLightMaterial >= 0:    # negative values are standard lighting modes
+            lightMaterialUsed[ vertexStates[i].iLightMaterial ] = True
+    colorUsed = [ False ] * len( ExportShape.Colors )
+    for i in range( 0, len( ExportShape.LightMaterials ) ):
+        if lightMaterialUsed[i]:
+            for iColor in ExportShape.LightMaterials[i][:4]:      # diff, amb, spec, emmisive
+                colorUsed[iColor] = True
+
+    # colours and light materials
+    keptColors, colorConversion = CompactTable( [ tuple( c ) for c in ExportShape.Colors ], colorUsed )
+    ExportShape.Colors = [ ExportShape.Colors[i] for i in keptColors ]
+    lightMaterials = [ tuple( colorConversion[iColor] for iColor in m[:4] ) + tuple( m[4:] ) for m in ExportShape.LightMaterials ]
+    keptLightMaterials, lightMaterialConversion = CompactTable( lightMaterials, lightMaterialUsed )
+    ExportShape.LightMaterials = [ lightMaterials[i] for i in keptLightMaterials ]
+
+    # vertex states, merging the vertex sets of merged states
+    for eachVertexState in vertexStates:
+        if eachVertexState.iLightMaterial >= 0:
+            eachVertexState.iLightMaterial = lightMaterialConversion[ eachVertexState.iLightMaterial ]
+    vertexStateKeys = [ ( v.Flags, v.iMatrix, v.iLightMaterial, v.iLightConfig ) for v in vertexStates ]
+    keptVertexStates, vertexStateConversion = CompactTable( vertexStateKeys, vertexStateUsed )
+    ExportShape.VertexStates = InternTable()
+    for i in keptVertexStates:
+        ExportShape.VertexStates.Add( vertexStateKeys[i], vertexStates[i] )
+
+    # prim states, keeping their old vertex states for merging the vertex sets
+    primStateVertexStates = [ p.iVertexState for p in primStates ]
+    for eachPrimState in primStates:
+        if vertexStateConversion[ eachPrimState.iVertexState ] != -1:
+            eachPrimState.iVertexState = vertexStateConversion[ eachPrimState.iVertexState ]
+    primStateKeys = [ ( p.iVertexState, p.zBias, p.iShader, p.AlphaTestMode, p.iLightConfig, tuple( p.iTextures ) ) for p in primStates ]
+    keptPrimStates, primStateConversion = CompactTable( primStateKeys, primStateUsed )
+    ExportShape.PrimStates = InternTable()
+    for i in keptPrimStates:
+        ExportShape.PrimStates.Add( primStateKeys[i], primStates[i] )
+
+    # uv points and normals, across all the meshes
+    if len( iUVs ) > 0:
+        ExportShape.UVPoints, uvConversion = CompactPointTable( ExportShape.UVPoints, numpy.concatenate( iUVs ), 0.0001 )
+        ExportShape.Normals, normalConversion = CompactPointTable( ExportShape.Normals, numpy.concatenate( iNormals ), 0.001 )
+
+    # then remap the subobjects, one distance level at a time
+    for eachDistanceLevel in EachDistanceLevel():
+        for eachSubObject in eachDistanceLevel.SubObjects:
+            newVertexSets = {}
+            offsets = {}    # keyed on old iVertexState, where its vertices start in the merged vertex set
+            for iVertexState in sorted( eachSubObject.VertexSets ):
+                oldVertexSet = eachSubObject.VertexSets[iVertexState]
+                if vertexStateConversion[iVertexState] == -1:
+                    continue
+                vertexSet = newVertexSets.get( vertexStateConversion[iVertexState] )
+                if vertexSet == None:
+                    newVertexSets[ vertexStateConversion[iVertexState] ] = oldVertexSet
+                    offsets[iVertexState] = 0
+                else:
+                    offsets[iVertexState] = len( vertexSet )
+                    vertexSet.Extend( oldVertexSet )
+            for eachPrimitive in eachSubObject.Primitives:
+                offset = offsets[ primStateVertexStates[ eachPrimitive.iPrimState ] ]
+                if offset > 0:
+                    eachPrimitive.Triangles = array( 'i', ( numpy.frombuffer( eachPrimitive.Triangles, dtype=numpy.int32 ) + offset ).tobytes() )
+                eachPrimitive.iPrimState = primStateConversion[ eachPrimitive.iPrimState ]
+                if len( iUVs ) > 0:
+                    eachPrimitive.iNormals = RemapIndexes( eachPrimitive.iNormals, normalConversion )
+            eachSubObject.VertexSets = newVertexSets
+            for eachVertexSet in newVertexSets.values():
+                eachVertexSet.iUVs = RemapIndexes( eachVertexSet.iUVs, uvConversion )
+                eachVertexSet.iNormals = RemapIndexes( eachVertexSet.iNormals, normalConversion )
 
 
 #####################################
@@ -2012,19 +2669,63 @@ class SceneCenterObject:    # a proxy to represent a node object at the center o
         return default
 
 #####################################
-def ExportShapeFile( collectionName, MSTSFilePath ):
+# the file each root collection is exported to, the first to exportPath and the others alongside it
+# eg loco.s for MAIN, then loco_SNOWPLOW.s for SNOWPLOW
+def RootExportPath( exportPath, rootNames, i ):
+    if i == 0:
+        return exportPath
+    stem, extension = os.path.splitext( exportPath )
+    return stem + '_' + MSTSName( rootNames[i] ) + extension
+
+#####################################
+# export each of the root collections to its own shape file, see RootExportPath
+# the evaluated meshes and the material settings are shared by all the shapes,
+# so variants of a shape that use the same objects are only extracted from Blender once
+# returns the files written, none for an estimate
+def ExportShapeFiles( rootNames, exportPath ):
+
+    global MeshCache
+    global MaterialSettings
+    MeshCache = LRUCache( MeshCacheCorners )
+    MaterialSettings = {}   # keyed on material, its MSTSMaterialSettings
+
+    filePaths = []
+    try:
+        for i in range( 0, len( rootNames ) ):
+            filePaths.append( RootExportPath( exportPath, rootNames, i ) )
+            ExportShapeFile( rootNames[i], filePaths[i], keepMeshes = i < len( rootNames ) - 1 )
+    finally:
+        MeshCache.Clear()
+        MaterialSettings.clear()
+    if EstimateOnly:
+        return []
+    return filePaths
+
+#####################################
+def ExportShapeFile( collectionName, MSTSFilePath, keepMeshes = False ):
+
+    startTime = time.time()
 
     global ExportShape
     ExportShape = Shape()
 
+    global SpillFolder
+    SpillFolder = None
+    if LowMemory:
+        SpillFolder = tempfile.TemporaryDirectory( prefix = 'msts_export_' )  # removed when the export ends, or when released after an error
+        ExportShape.SpillFolder = SpillFolder.name
+
     global UniqueUVPoints
     global UniqueNormals
     global UniqueColors
     global UniqueLightMaterials
-    UniqueUVPoints = UniqueArray( ExportShape.UVPoints, 3, 0.0001 )
-    UniqueNormals = UniqueArray( ExportShape.Normals, 2, 0.001 )
-    UniqueColors = UniqueArray( ExportShape.Colors, 3, 0.0001 )
-    UniqueLightMaterials = UniqueArray( ExportShape.LightMaterials, 1,1 )
+    UniqueUVPoints = UniqueArray( ExportShape.UVPoints, 0.0001 )
+    UniqueNormals = UniqueArray( ExportShape.Normals, 0.001 )
+    UniqueColors = UniqueArray( ExportShape.Colors, 0.0001 )
+    UniqueLightMaterials = UniqueArray( ExportShape.LightMaterials, 1 )
+
+    global MaterialDetails
+    MaterialDetails = {}    # keyed on ( material, distance level, hierarchy node ), its MSTSMaterialDetail
 
     global UpperBound
     global LowerBound
@@ -2033,8 +2734,12 @@ def ExportShapeFile( collectionName, MSTSFilePath ):
 
     global hierarchy        # linked list ie [-1,    0,1,1,0 ]
     global hierarchyObjects  # a list of objects for each level of the hierarchy, first element in list is the retained node [ MAIN, BOGIE1, WHEELS11, WHEELS12 .. ]
+    global hierarchyMatrices    # for each object in hierarchyObjects, the cumulative transfer matrix to its retained node
+    global hierarchyParentMatrices  # for each level of the hierarchy, the cumulative transfer matrix to its parent's node
     hierarchy = []
     hierarchyObjects = []
+    hierarchyMatrices = []
+    hierarchyParentMatrices = []
 
     global LastSubObject
     global LastMaterial
@@ -2051,11 +2756,11 @@ def ExportShapeFile( collectionName, MSTSFilePath ):
 
     mainCollection = bpy.context.scene.collection.children[collectionName]
 
-    # get a sorted list of valid LOD Collections in MAIN
+    # get a sorted list of valid LOD Collections in MAIN, ie those named for the root collection
     lodNames = []
     for eachChild in mainCollection.children:
         childName = eachChild.name
-        if childName.startswith( 'MAIN_' ):
+        if childName.startswith( collectionName + '_' ):
             if LodDistanceFromName( childName ) != None:
                 lodNames.append( childName )
     
@@ -2078,7 +2783,10 @@ def ExportShapeFile( collectionName, MSTSFilePath ):
         LodCollections.append( mainCollection.children[eachName] )
 
     if len( LodCollections ) == 0:
-        raise MyException( "No LOD collections in MAIN, eg MAIN_2000" )
+        raise MyException( "No LOD collections in {0}, eg {0}_2000".format( collectionName ) )
+
+    global LodMembership
+    LodMembership = BuildLodMembership( LodCollections )
 
 
     # add root objects to scene center
@@ -2087,7 +2795,7 @@ def ExportShapeFile( collectionName, MSTSFilePath ):
         if eachObject.parent == None:
             rootObject.children.append( eachObject)
 
-    BuildHierarchyFrom( rootObject, -1 )  # create global hierarchy array
+    BuildHierarchyFrom( rootObject, -1, None )  # create global hierarchy array
 
     CreateMSTSMatrices( )
 
@@ -2114,34 +2822,95 @@ def ExportShapeFile( collectionName, MSTSFilePath ):
     volumeSphere.Radius = radius * 1.1  # add some safety margin
     ExportShape.Volumes.append( volumeSphere )
 
+    if keepMeshes:      # for the shapes of the other root collections, see ExportShapeFiles
+        MeshCache.Discard( lambda value: isinstance( value, MeshPlacement ) )
+    else:
+        MeshCache.Clear()
+    MaterialDetails.clear()
+
     print()
     print ( "Compacting ",len( ExportShape.Points )," Points ", end='' )
     CompactPoints()
     print ( " To ",len( ExportShape.Points ) )
-    CompactPrimitives()
-    CompactSubObjects()
+    if ExportShape.SpillFolder == None:   # otherwise done as each distance level was spilled
+        for eachLODControl in ExportShape.LodControls:
+            for eachDistanceLevel in eachLODControl.DistanceLevels:
+                CompactDistanceLevel( eachDistanceLevel )
+    if EstimateOnly:
+        ReportEstimate()
+        FinishExport( startTime )
+        return
+
+    if CompactTables:
+        CompactShapeTables()
 
-    ExportShape.Write( MSTSFilePath )
+    ExportShape.Write( MSTSFilePath, CompressShape )
 
     # Reporting
     print ( )
-    for lodControl in ExportShape.LodControls:
-        for distanceLevel in lodControl.DistanceLevels:
-            triangleCount = 0
-            primitiveCount = 0
-            for eachSubObject in distanceLevel.SubObjects:
-                for primitive in eachSubObject.Primitives:
-                    if len( primitive.Triangles ) > 0:
-                        primitiveCount += 1
-                        triangleCount += len(primitive.Triangles)
-            print ( "LOD: ",distanceLevel.Selection )
-            print ( "     Triangles  = ", triangleCount )
-            print ( "     Draw Calls = ", primitiveCount )
+    for distanceLevel in EachDistanceLevel( False ):
+        triangleCount = 0
+        primitiveCount = 0
+        for eachSubObject in distanceLevel.SubObjects:
+            triangleCount += eachSubObject.TriangleCount
+            for primitive in eachSubObject.Primitives:
+                if primitive.TriangleCount > 0:
+                    primitiveCount += 1
+        print ( "LOD: ",distanceLevel.Selection )
+        print ( "     Triangles  = ", triangleCount )
+        print ( "     Draw Calls = ", primitiveCount )
+    FinishExport( startTime )
+    return
+
+#####################################
+# report the images, release the spilled distance levels and report the time taken
+def FinishExport( startTime ):
+
+    global SpillFolder
+
     print ( "IMAGES:" )
     for eachImage in ExportShape.Images:
         print( "   ",eachImage )
+    if SpillFolder != None:
+        SpillFolder.cleanup()
+        SpillFolder = None
+    print ( "EXPORT TIME: {0:.1f} sec".format( time.time() - startTime ) )
     print()
-    return
+
+#####################################
+# for EstimateOnly, report each LOD of the unwritten shape, with the approximate size of the file
+# the uv points and normals are counted before CompactTables would remove their duplicates
+def ReportEstimate():
+
+    sizes, unit = EstimateTextSizes, 2      # utf-16 text
+    shapeSize = sizes['shape'] + sizes['point'] * len( ExportShape.Points ) + sizes['uv_point'] * len( ExportShape.UVPoints ) + sizes['vector'] * len( ExportShape.Normals )
+
+    print ( )
+    print ( "ESTIMATE, NO FILE WRITTEN" )
+    print ( "     Points     = ", len( ExportShape.Points ) )
+    print ( "     UV Points  = ", len( ExportShape.UVPoints ) )
+    print ( "     Normals    = ", len( ExportShape.Normals ) )
+    for distanceLevel in EachDistanceLevel( False ):
+        triangleCount = 0
+        primitiveCount = 0
+        vertexSetSizes = []
+        for eachSubObject in distanceLevel.SubObjects:
+            triangleCount += eachSubObject.TriangleCount
+            primitiveCount += len( eachSubObject.Primitives )
+            vertexSetSizes.extend( eachSubObject.VertexSetCounts.values() )
+        vertexCount = sum( vertexSetSizes )
+        levelSize = sizes['sub_object'] * len( distanceLevel.SubObjects ) + sizes['vertex'] * vertexCount + sizes['triangle'] * triangleCount
+        shapeSize += levelSize
+        print ( "LOD: ",distanceLevel.Selection )
+        print ( "     Triangles  = ", triangleCount )
+        print ( "     Draw Calls = ", primitiveCount )
+        print ( "     Sub Objects = ", len( distanceLevel.SubObjects ) )
+        print ( "     Vertices   = ", vertexCount, " in ", len( vertexSetSizes ), " vertex sets, largest ", max( vertexSetSizes, default=0 ) )
+        print ( "     Size       =  {0:.1f} MB".format( levelSize * unit / 1000000 ) )
+    if CompressShape:
+        print ( "APPROXIMATE FILE SIZE: {0:.1f} MB, before compression".format( shapeSize * unit / 1000000 ) )
+    else:
+        print ( "APPROXIMATE FILE SIZE: {0:.1f} MB".format( shapeSize * unit / 1000000 ) )
 
 
 '''  LIBRARY FUNCTIONS
@@ -2155,7 +2924,6 @@ Matrix
 VertexState
 Texture
 PrimState
-Vertex
 Primitive
 VertexSet
 SubObject
@@ -2171,7 +2939,7 @@ Animation
 
 This structure matches the MSTS .s file with the following exceptions
 
-Add vertices to vertex_sets, not subobject.vertices as in MSTS.
+Add vertices to vertex_sets ( stored by column in typed arrays ), not subobject.vertices as in MSTS.
 It not needed to populate the sub_object_header data.
 
     Both of the above are generated from the underlying data on write.
@@ -2179,6 +2947,11 @@ It not needed to populate the sub_object_header data.
 '''
 
 import codecs
+import struct
+import zlib
+import pickle
+import tempfile
+from .stf_render import RenderPoints, RenderVertices, RenderTrilist
 import bpy
 
 import math
@@ -2186,27 +2959,166 @@ from math import *
 
 
 
+####################################
+class CompressedStream:
+####################################
+#
+# A unicode text file in the MSTS SIMISA@F container,
+# everything written is compressed with zlib as it arrives.
+# The header is utf-16 with a BOM, as readers take the encoding of the compressed text from it,
+# 'SIMISA@F', the uncompressed byte count, filled in on close, then '@@@@@@'.
+#
+# STFWriter writes each block of text as it is flushed.
+#
+
+        LengthOffset = 18       # after the BOM and 'SIMISA@F'
+
+        def __init__( self, filename ):
+                self.f = open( filename, 'wb' )
+                self.f.write( codecs.BOM_UTF16_LE + 'SIMISA@F'.encode( 'utf-16-le' ) + b'\0\0\0\0' + '@@@@@@'.encode( 'utf-16-le' ) )
+                self.Compressor = zlib.compressobj()
+                self.Length = 0
+
+        def write( self, data ):
+                self.Length += len( data )
+                self.f.write( self.Compressor.compress( data ) )
+
+        def close( self ):
+                self.f.write( self.Compressor.flush() )
+                self.f.seek( self.LengthOffset )
+                self.f.write( struct.pack( '<I', self.Length ) )
+                self.f.close()
+
+
+
 ####################################
 class STFWriter:
 ####################################
 #
 # Writes an MSTS structured unicode text file
+#
+# Text is held in a list of strings and encoded in blocks,
+# rather than passing each small write through the codec.
 #
 
+        BufferSize = 16384      # strings held before they are encoded and written
 
-        def __init__( self, filename):
-                self.f = codecs.open(filename, 'w', encoding='utf-16')
+        def __init__( self, filename, compress = False ):
+                self.Compressed = compress
+                if compress:
+                        self.f = CompressedStream( filename )
+                        self.Encoder = codecs.getincrementalencoder( 'utf-16-le' )()    # no BOM inside the compressed stream
+                else:
+                        self.f = open( filename, 'wb' )
+                        self.Encoder = codecs.getincrementalencoder( 'utf-16' )()   # writes the BOM with the first block
+                self.Buffer = []
 
         def WriteLine( self, string ):
-                self.f.write( string )
-                self.f.write( '\r\n' )
+                self.Buffer.append( string )
+                self.Buffer.append( '\r\n' )
+                if len( self.Buffer ) >= self.BufferSize:
+                        self.Flush()
 
         def Write( self, string ):
-                self.f.write( string )
+                self.Buffer.append( string )
+                if len( self.Buffer ) >= self.BufferSize:
+                        self.Flush()
+
+        def WriteHeader( self ):
+                if self.Compressed:
+                        self.WriteLine( 'JINX0s1t______\r\n' )   # CompressedStream wrote the SIMISA@F part
+                else:
+                        self.WriteLine( 'SIMISA@@@@@@@@@@JINX0s1t______\r\n' )
+
+        # write a large section, ie render( *args ) from stf_render
+        def WriteSection( self, render, *args ):
+                self.Write( render( *args ) )
+
+        def Flush( self ):
+                if self.Buffer:
+                        self.f.write( self.Encoder.encode( ''.join( self.Buffer ) ) )
+                        self.Buffer = []
 
         def Close(self ):
+                self.Flush()
                 self.f.close()
 
+        # after an error, release the file
+        def Abort( self ):
+                self.f.close()
+
+
+
+########################################
+class InternTable( list ):
+####################################
+#
+# A shape table where each entry is stored once,
+# found by a hashable key such as a name or a tuple of the entry's settings.
+# When entries share a key, the last one added is found.
+#
+
+        def __init__( self ):
+                super().__init__()
+                self.Index = {}     # keyed on entry key, index of the entry
+
+        def Find( self, key ):
+                return self.Index.get( key, -1 )
+
+        def Add( self, key, entry ):
+                i = len( self )
+                self.append( entry )
+                self.Index[key] = i
+                return i
+
+
+
+########################################
+class PointTable:
+####################################
+#
+# A shape table of fixed width tuples, ie points, uv points and normals,
+# stored flat as doubles rather than as a list of tuples.
+#
+
+        __slots__ = ( 'Values', 'Width' )
+
+        SectionRows = 50000     # rows rendered at a time, see STFWriter.WriteSection
+
+        def __init__( self, width ):
+                self.Values = array( 'd' )
+                self.Width = width
+
+        def __len__( self ):
+                return len( self.Values ) // self.Width
+
+        def __getitem__( self, i ):
+                if i < 0:
+                        i += len( self )
+                return tuple( self.Values[ i * self.Width : ( i + 1 ) * self.Width ] )
+
+        def __iter__( self ):
+                for i in range( 0, len( self ) ):
+                        yield self[i]
+
+        def append( self, value ):
+                self.Values.extend( value )
+
+        # write the rows as blockName ( values ) in sections of SectionRows
+        def WriteRows( self, stf, blockName ):
+                for start in range( 0, len( self ), self.SectionRows ):
+                        stop = min( start + self.SectionRows, len( self ) )
+                        stf.WriteSection( RenderPoints, blockName, self.Values[ start * self.Width : stop * self.Width ], self.Width )
+
+        # values is an ( n, Width ) numpy array
+        def ExtendArray( self, values ):
+                self.Values.frombytes( numpy.ascontiguousarray( values, dtype=numpy.float64 ).tobytes() )
+
+        # return a new table of the rows at indexes, a numpy array
+        def Select( self, indexes ):
+                table = PointTable( self.Width )
+                table.ExtendArray( numpy.frombuffer( self.Values, dtype=numpy.float64 ).reshape( -1, self.Width )[indexes] )
+                return table
 
 
 
@@ -2339,78 +3251,26 @@ class PrimState:
 
 
 ########################################
-class Vertex:
+class Primitive:
 
-        # eg vertex ( 00000000 0 0 ffffffff ff000000
-        #        vertex_uvs ( 1 0 )
-        #               )
+        __slots__ = ( 'iPrimState', 'Triangles', 'iNormals', 'TriangleCount' )
 
         def __init__( self ):
-                self.iPoint = 0
-                self.iNormal = 0
-                self.iUVs = []  #TODO multiple UV's
-                self.Color1 = 0xffffffff
-                self.Color2 = 0xff000000
-
-
-        def Write( self, stf ):
-                stf.WriteLine( '                                vertex ( 00000000 {0} {1} {2:08X} {3:08X}'.format(self.iPoint,self.iNormal,self.Color1, self.Color2 ) )
-                stf.Write( '                                    vertex_uvs ( {0}'.format( len(self.iUVs) ) )
-                for eachiUV in self.iUVs:
-                    stf.Write( ' {0}'.format(eachiUV))
-                stf.WriteLine( ' )' )
-                stf.WriteLine( '                                )')
-
-
-
-########################################
+                self.iPrimState = 0
+                self.Triangles = array( 'i' )   # three vertex indexes per triangle, relative to the vertex set
+                self.iNormals = array( 'i' )    # face normal index per triangle
+                self.TriangleCount = 0  # not exported, running count of Triangles
 
-class Primitive:
 
-        def __init__( self ):
-                self.iPrimState = 0
-                self.Triangles = []
-                self.iNormals = []
+        # triangles is a ( n, 3 ) array of vertex indexes, iNormals a ( n ) array of face normal indexes
+        def AddTriangles( self, triangles, iNormals ):
+                self.Triangles.frombytes( numpy.ascontiguousarray( triangles, dtype=numpy.int32 ).tobytes() )
+                self.iNormals.frombytes( numpy.ascontiguousarray( iNormals, dtype=numpy.int32 ).tobytes() )
+                self.TriangleCount += len( triangles )
 
 
         def Write( self, stf, indexOffset ):
-                stf.WriteLine( '                                indexed_trilist (' )
-
-                stf.Write( '                                    vertex_idxs ( {0} '.format( len(self.Triangles) * 3) )
-                linecount = 0
-                for eachTriangle in self.Triangles:
-                        for eachIndex in eachTriangle:
-                                stf.Write( '{0} '.format( eachIndex + indexOffset ) )
-                                linecount += 1
-                                if linecount > 100:
-                                        linecount = 0
-                                        stf.WriteLine( '' )
-                                        stf.Write( '                                    ')
-                stf.WriteLine( ')') #vertex_idxs
-
-                stf.Write( '                                    normal_idxs ( {0} '.format( len(self.Triangles)) )
-                linecount = 0
-                for i in self.iNormals:
-                            stf.Write( '{0} 3 '.format( i ) )
-                            linecount += 1
-                            if linecount > 100:
-                                    linecount = 0
-                                    stf.WriteLine( '' )
-                                    stf.Write( '                                    ')
-                stf.WriteLine( ')') #normal_idxs
-
-                stf.Write( '                                    flags ( {0} '.format( len(self.Triangles)) )
-                linecount = 0
-                for i in self.iNormals:
-                            stf.Write( '00000000 ' )
-                            linecount += 1
-                            if linecount > 100:
-                                    linecount = 0
-                                    stf.WriteLine( '' )
-                                    stf.Write( '                                    ')
-                stf.WriteLine( ')') #flags
-
-                stf.WriteLine( '                                )') #indexed_trilist
+                stf.WriteSection( RenderTrilist, self.Triangles, self.iNormals, self.TriangleCount, indexOffset )
 
 
 ########################################
@@ -2429,10 +3289,48 @@ class GeometryInfoPerMatrix:
 ########################################
 class VertexSet:
 
+        # vertices are stored by column, eg vertex ( 00000000 iPoint iNormal Color1 Color2
+        #                                      vertex_uvs ( UVCount iUVs.. )
+        #                                           )
+
+        __slots__ = ( 'iPoints', 'iNormals', 'UVCounts', 'iUVs', 'Colors1', 'Colors2', 'iStart', 'index' )
+
         def __init__( self ):
-                self.Vertices = []
+                self.iPoints = array( 'i' )
+                self.iNormals = array( 'i' )
+                self.UVCounts = array( 'B' )
+                self.iUVs = array( 'i' )        # the uvs of every vertex, one after the other
+                self.Colors1 = array( 'I' )
+                self.Colors2 = array( 'I' )
                 self.iStart = 0     # first vertex used by this set
-                self.index = {}     # not exported, keyed on iPoint, list of iVertex referencing that point
+                self.index = {}     # not exported, keyed on VertexKeys( iPoint, iNormal, iUVs.. ), iVertex with those values
+
+        def __len__( self ):
+                return len( self.iPoints )
+
+        # keys is a ( n, 2 + uv layers ) array of ( iPoint, iNormal, iUVs.. ) rows
+        def AddVertices( self, keys, color1, color2 ):
+                keys = numpy.ascontiguousarray( keys, dtype=numpy.int32 )
+                count = len( keys )
+                self.iPoints.frombytes( keys[ :, 0 ].tobytes() )
+                self.iNormals.frombytes( keys[ :, 1 ].tobytes() )
+                self.UVCounts.extend( [ keys.shape[1] - 2 ] * count )
+                self.iUVs.frombytes( keys[ :, 2: ].tobytes() )
+                self.Colors1.extend( [ color1 ] * count )
+                self.Colors2.extend( [ color2 ] * count )
+
+        # append the vertices of another vertex set
+        def Extend( self, other ):
+                self.iPoints.extend( other.iPoints )
+                self.iNormals.extend( other.iNormals )
+                self.UVCounts.extend( other.UVCounts )
+                self.iUVs.extend( other.iUVs )
+                self.Colors1.extend( other.Colors1 )
+                self.Colors2.extend( other.Colors2 )
+                self.index = {}     # no longer needed once vertex sets are merged
+
+        def WriteVertices( self, stf ):
+                stf.WriteSection( RenderVertices, self.iPoints, self.iNormals, self.Colors1, self.Colors2, self.UVCounts, self.iUVs )
 
 
 ########################################
@@ -2440,15 +3338,36 @@ class SubObject:
 
 
         def __init__( self, parent ):
-                self.VertexSets = []
+                self.VertexSets = {}    # keyed on iVertexState, created on first use
                 self.Primitives = []
                 self.DistanceLevel = parent
                 self.Flags = '00000400 -1 -1 000001d2 000001c4'
                 self.Priority = 0       # sub_objects are sorted by this number, 0 comes first
                 self.iHierarchy = 0     # not exported, see HierarchyOptimization
+                self.VertexCount = 0    # not exported, running count of vertices in all the VertexSets
+                self.VertexSetCounts = {}   # not exported, keyed on iVertexState, the vertices counted in place of each VertexSet by EstimateOnly
+                self.TriangleCount = 0  # not exported, running count of triangles in all the Primitives
+                self.iLastPrimitives = {}   # not exported, keyed on iPrimState, the last primitive using it
                 self.sequence = len( self.DistanceLevel.SubObjects )  # not exported, for debugging
 
 
+        # pickled when the distance level is spilled, without the links that are only needed while building it
+        def __getstate__( self ):
+                state = self.__dict__.copy()
+                state['DistanceLevel'] = None
+                state['iLastPrimitives'] = {}
+                return state
+
+
+        # return the vertex set for the vertex state, creating it if needed
+        def GetVertexSet( self, iVertexState ):
+                vertexSet = self.VertexSets.get( iVertexState )
+                if vertexSet == None:
+                        vertexSet = VertexSet()
+                        self.VertexSets[iVertexState] = vertexSet
+                return vertexSet
+
+
         def Write( self, stf ):
                 stf.WriteLine( '                        sub_object (' )
                 self.WriteSubObjectHeader( stf )
@@ -2480,8 +3399,8 @@ class SubObject:
                         vertexState = shape.VertexStates[primState.iVertexState]
                         iMatrix = vertexState.iMatrix
                         matrixInfo[iMatrix].PrimitivesCount += 1
-                        matrixInfo[iMatrix].TrianglesCount += len(primitive.Triangles)
-                        matrixInfo[iMatrix].VerticesCount += len(primitive.Triangles) * 3
+                        matrixInfo[iMatrix].TrianglesCount += primitive.TriangleCount
+                        matrixInfo[iMatrix].VerticesCount += primitive.TriangleCount * 3
                         matrixInfo[iMatrix].VertexStatesUsed[primState.iVertexState] = True
                 # Calculate VertexStates (txLightCmds) per matrix
                 for i in range( 0, len(matrixInfo) ):
@@ -2490,13 +3409,11 @@ class SubObject:
                                 if b : matrixInfo[i].VertexStatesCount += 1
                 # Now update the summary data
                 # Calculate FaceNormals
-                faceNormalsCount = 0
-                for primitive in self.Primitives:
-                        faceNormalsCount += len(primitive.Triangles)
+                faceNormalsCount = self.TriangleCount
                 # Calculate number of vtx_states used by primitives in this sub_objects
                 vertexStatesCount = 0
-                for eachVertexSet in self.VertexSets:
-                    if len(eachVertexSet.Vertices)>0:
+                for eachVertexSet in self.VertexSets.values():
+                    if len(eachVertexSet)>0:
                         vertexStatesCount += 1
                 # Calculate number of vertices (VertIdxs) in all the vertex_idxs statements ( 3 x FaceNormals )
                 verticesCount = faceNormalsCount * 3
@@ -2558,34 +3475,30 @@ class SubObject:
                 stf.WriteLine( ' 0' )  # [:uint,SubObjID]
 
         def WriteVertices( self, stf ):  # and set start location for vertex_set's
-                # count the vertices
-                count = 0
-                for vertexSet in self.VertexSets:
-                        count += len( vertexSet.Vertices )
-                stf.WriteLine( '                            vertices ( {0}'.format(count))
+                stf.WriteLine( '                            vertices ( {0}'.format(self.VertexCount))
                 # write out the vertices
                 iStart = 0
-                for vertexSet in self.VertexSets:
+                for iVertexState in sorted( self.VertexSets ):
+                    vertexSet = self.VertexSets[iVertexState]
                     vertexSet.iStart = iStart
-                    for vertex in vertexSet.Vertices:
-                        vertex.Write( stf )
-                    iStart += len( vertexSet.Vertices )
+                    vertexSet.WriteVertices( stf )
+                    iStart += len( vertexSet )
                 stf.WriteLine( '                            )') # vertices
 
 
         def WriteVertexSets( self, stf ):
                 # count the vertex sets
                 count = 0
-                for vertexSet in self.VertexSets:
-                        if len( vertexSet.Vertices ) > 0:
+                for vertexSet in self.VertexSets.values():
+                        if len( vertexSet ) > 0:
                                 count += 1
                 stf.WriteLine( '                            vertex_sets ( {0}'.format(count) )
 
-                # write out the vertex sets
-                for i in range( 0, len( self.VertexSets ) ):
+                # write out the vertex sets in vertex state order
+                for i in sorted( self.VertexSets ):
                         vertexSet = self.VertexSets[i]
-                        if len( vertexSet.Vertices ) > 0:
-                                stf.WriteLine( '                                vertex_set ( {0} {1} {2} )'.format(i,vertexSet.iStart,len(vertexSet.Vertices)))
+                        if len( vertexSet ) > 0:
+                                stf.WriteLine( '                                vertex_set ( {0} {1} {2} )'.format(i,vertexSet.iStart,len(vertexSet)))
 
                 stf.WriteLine( '                            )' ) #vertex_sets
                 return
@@ -2631,8 +3544,39 @@ class DistanceLevel:
         def __init__(self,parent):
                 self.LodControl = parent
                 self.SubObjects = []
+                self.LastSubObjects = {}    # not exported, keyed on SubObjectKey, the last subobject with those flags
                 self.Selection = 0      # maximum distance this distance level is visible
                 self.Hierarchy = []
+                self.SpillPath = None   # not exported, the temporary file holding the subobjects once spilled
+
+
+        # move the subobjects to a temporary file in the shape's SpillFolder, and release them
+        # they are reloaded by Load whenever a later pass needs them
+        def Spill( self ):
+                if self.SpillPath == None:
+                        handle, self.SpillPath = tempfile.mkstemp( suffix = '.dlevel', dir = self.LodControl.Shape.SpillFolder )
+                        os.close( handle )
+                for eachSubObject in self.SubObjects:
+                        for eachVertexSet in eachSubObject.VertexSets.values():
+                                eachVertexSet.index = {}    # only used while vertices are added
+                with open( self.SpillPath, 'wb' ) as f:
+                        pickle.dump( self.SubObjects, f, pickle.HIGHEST_PROTOCOL )
+                self.SubObjects = None
+                self.LastSubObjects = {}
+
+
+        def Load( self ):
+                if self.SubObjects == None:
+                        with open( self.SpillPath, 'rb' ) as f:
+                                self.SubObjects = pickle.load( f )
+                        for eachSubObject in self.SubObjects:
+                                eachSubObject.DistanceLevel = self
+
+
+        # release a spilled distance level again without rewriting it, when it was only read
+        def Unload( self ):
+                if self.SpillPath != None:
+                        self.SubObjects = None
 
 
         def Write( self, stf ):
@@ -2641,11 +3585,13 @@ class DistanceLevel:
 
                 self.WriteHeader( stf )
 
+                self.Load()
                 count = len( self.SubObjects )
                 stf.WriteLine( '                    sub_objects ( {0}'.format(count))
                 for i in range( 0,count):
                     self.SubObjects[i].Write(stf)
                 stf.WriteLine( '                    )')
+                self.Unload()
 
                 stf.WriteLine( '                )')
 
@@ -2814,47 +3760,52 @@ class Shape:
 
         def __init__( self ):
                 self.Volumes = []
-                self.Shaders = []
-                self.Filters = []
-                self.Points = []
-                self.UVPoints = []
-                self.Normals = []
+                self.Shaders = InternTable()
+                self.Filters = InternTable()
+                self.Points = PointTable( 3 )
+                self.UVPoints = PointTable( 2 )
+                self.Normals = PointTable( 3 )
                 self.Matrices = []
-                self.Images = []
-                self.Textures = []
+                self.Images = InternTable()
+                self.Textures = InternTable()
                 self.Colors = []
                 self.LightMaterials = []
-                self.LightConfigs = []
-                self.VertexStates = []
-                self.PrimStates = []
+                self.LightConfigs = InternTable()
+                self.VertexStates = InternTable()
+                self.PrimStates = InternTable()
                 self.LodControls = []
                 self.Animations = []
-
-
-
-        def Write( self, filepath ):
-                stf = STFWriter( filepath )
-                stf.WriteLine( 'SIMISA@@@@@@@@@@JINX0s1t______\r\n' )
-                stf.WriteLine( 'shape (' )
-                stf.WriteLine( '    shape_header ( 00000000 00000000 )' )
-                self.WriteVolumes( stf )
-                self.WriteShaders( stf )
-                self.WriteFilters( stf )
-                self.WritePoints( stf )
-                self.WriteUVPoints( stf )
-                self.WriteNormals( stf )
-                self.WriteSortVectors( stf )
-                self.WriteColours( stf )
-                self.WriteMatrices( stf )
-                self.WriteImages(stf)
-                self.WriteTextures(stf )
-                self.WriteLightMaterials(stf)
-                self.WriteLightConfigs( stf )
-                self.WriteVertexStates(stf)
-                self.WritePrimStates(stf)
-                self.WriteLodControls(stf)
-                self.WriteAnimations(stf)
-                stf.WriteLine( ')' )
+                self.SpillFolder = None     # not exported, when set, completed distance levels are spilled to this folder
+
+
+
+        def Write( self, filepath, compress = False ):
+                stf = STFWriter( filepath, compress )
+                try:
+                        stf.WriteHeader()
+                        stf.WriteLine( 'shape (' )
+                        stf.WriteLine( '    shape_header ( 00000000 00000000 )' )
+                        self.WriteVolumes( stf )
+                        self.WriteShaders( stf )
+                        self.WriteFilters( stf )
+                        self.WritePoints( stf )
+                        self.WriteUVPoints( stf )
+                        self.WriteNormals( stf )
+                        self.WriteSortVectors( stf )
+                        self.WriteColours( stf )
+                        self.WriteMatrices( stf )
+                        self.WriteImages(stf)
+                        self.WriteTextures(stf )
+                        self.WriteLightMaterials(stf)
+                        self.WriteLightConfigs( stf )
+                        self.WriteVertexStates(stf)
+                        self.WritePrimStates(stf)
+                        self.WriteLodControls(stf)
+                        self.WriteAnimations(stf)
+                        stf.WriteLine( ')' )
+                except:
+                        stf.Abort()
+                        raise
                 stf.Close()
 
         def WriteVolumes( self, stf ):
@@ -2886,9 +3837,7 @@ class Shape:
                 print ("Writing points")
                 count =  len( self.Points )
                 stf.WriteLine( '    points ( {0}'.format(count) )
-                for i in range( 0, count ):
-                    p = self.Points[i]
-                    stf.WriteLine( '        point ( {0} {1} {2} )'.format(round(p[0],6),round(p[1],6),round(p[2],6) ) )
+                self.Points.WriteRows( stf, 'point' )
                 stf.WriteLine( '    )' )
 
 
@@ -2896,9 +3845,7 @@ class Shape:
                 print ("Writing uv points")
                 count =  len( self.UVPoints )
                 stf.WriteLine( '    uv_points ( {0}'.format(count) )
-                for i in range( 0, count ):
-                    p = self.UVPoints[i]
-                    stf.WriteLine( '        uv_point ( {0} {1} )'.format(round(p[0],6),round(p[1],6)) )
+                self.UVPoints.WriteRows( stf, 'uv_point' )
                 stf.WriteLine( '    )' )
 
 
@@ -2906,9 +3853,7 @@ class Shape:
                 print ("Writing normals")
                 count =  len( self.Normals )
                 stf.WriteLine( '    normals ( {0}'.format(count) )
-                for i in range( 0, count ):
-                    p = self.Normals[i]
-                    stf.WriteLine( '        vector ( {0} {1} {2} )'.format(round(p[0],6),round(p[1],6),round(p[2],6) ) )
+                self.Normals.WriteRows( stf, 'vector' )
                 stf.WriteLine( '    )' )
 
         def WriteSortVectors( self, stf ):
@@ -3015,7 +3960,7 @@ if __name__ == "__main__":
    register()
 
 #   print( "START" )
-#   ExportShapeFile( 'MAIN', r'C:\MSTS\GLOBAL\SHAPES\LPSTrack100m.s' ) #r'c:\users\wayne\desktop\out.s' ) #
+#   ExportShapeFiles( [ 'MAIN' ], r'C:\MSTS\GLOBAL\SHAPES\LPSTrack100m.s' ) #r'c:\users\wayne\desktop\out.s' ) #
 #   print( "DONE" )
 
 
@@ -0,0 +1,92 @@
+'''
+Renders the large sections of an MSTS .s text file, ie the points, uv_points and normals tables,
+vertices and primitives, as text from plain data ( arrays, lists and sets ).
+
+Numbers are formatted a whole section at a time, by applying one format string to all its values,
+rather than formatting each number on its own.
+'''
+
+import numpy        # ships with Blender
+
+
+IndexLineLength = 101       # index lists are broken onto a new line after this many values
+IndexLineBreak = '\r\n                                    '
+
+
+########################################
+# text is numbers formatted with ' %.6f', the same rounding as round( v, 6 ), each followed by a space,
+# the trailing zeros are stripped, eg 1.500000 to 1.5, 1.000000 to 1 and -0.000000 to 0
+def StripZeros( text ):
+        # the six decimal places limit the zeros before a space to the fraction, 4 + 2 + 1 strips up to 6
+        text = text.replace( '0000 ', ' ' ).replace( '00 ', ' ' ).replace( '0 ', ' ' )
+        text = text.replace( '. ', ' ' )
+        return text.replace( ' -0 ', ' 0 ' ).replace( ' -0 ', ' 0 ' )   # twice for adjacent ones
+
+
+########################################
+# values is a flat array of rows, width values per row
+def RenderPoints( blockName, values, width ):
+        row = '        ' + blockName + ' (' + ' %.6f' * width + ' )\r\n'
+        return StripZeros( row * ( len( values ) // width ) % tuple( values ) )
+
+
+########################################
+# values formatted with valueFormat and broken onto lines of IndexLineLength values
+def RenderIndexList( values, valueFormat ):
+        lines, remainder = divmod( len( values ), IndexLineLength )
+        line = valueFormat * IndexLineLength + IndexLineBreak
+        return ( line * lines + valueFormat * remainder ) % tuple( values )
+
+
+########################################
+# the vertex blocks of one vertex set, stored by column
+def RenderVertices( iPoints, iNormals, colors1, colors2, uvCounts, iUVs ):
+        count = len( iPoints )
+        if count == 0:
+                return ''
+        uvCount = uvCounts[0]
+        if uvCounts.count( uvCount ) == count:   # the usual case, every vertex has the same number of uvs
+                columns = numpy.empty( ( count, 5 + uvCount ), dtype=numpy.int64 )
+                columns[:,0] = iPoints
+                columns[:,1] = iNormals
+                columns[:,2] = colors1
+                columns[:,3] = colors2
+                columns[:,4] = uvCount
+                columns[:,5:] = numpy.asarray( iUVs, dtype=numpy.int64 ).reshape( count, uvCount )
+                vertex = '                                vertex ( 00000000 %d %d %08X %08X\r\n' \
+                         '                                    vertex_uvs ( %d' + ' %d' * uvCount + ' )\r\n' \
+                         '                                )\r\n'
+                return vertex * count % tuple( columns.ravel().tolist() )
+        lines = []
+        iUV = 0
+        for i in range( 0, len( iPoints ) ):
+                lines.append( '                                vertex ( 00000000 {0} {1} {2:08X} {3:08X}\r\n'.format( iPoints[i], iNormals[i], colors1[i], colors2[i] ) )
+                uvCount = uvCounts[i]
+                lines.append( '                                    vertex_uvs ( {0}'.format( uvCount ) )
+                for eachiUV in iUVs[ iUV : iUV + uvCount ]:
+                        lines.append( ' {0}'.format( eachiUV ) )
+                iUV += uvCount
+                lines.append( ' )\r\n' )
+                lines.append( '                                )\r\n' )
+        return ''.join( lines )
+
+
+########################################
+# the indexed_trilist of one primitive, triangles are vertex indexes relative to the vertex set at indexOffset
+def RenderTrilist( triangles, iNormals, triangleCount, indexOffset ):
+        lines = [ '                                indexed_trilist (\r\n' ]
+
+        lines.append( '                                    vertex_idxs ( {0} '.format( triangleCount * 3 ) )
+        lines.append( RenderIndexList( ( numpy.frombuffer( triangles, dtype=numpy.int32 ) + indexOffset ).tolist(), '%d ' ) )
+        lines.append( ')\r\n' ) #vertex_idxs
+
+        lines.append( '                                    normal_idxs ( {0} '.format( triangleCount ) )
+        lines.append( RenderIndexList( iNormals.tolist(), '%d 3 ' ) )
+        lines.append( ')\r\n' ) #normal_idxs
+
+        lines.append( '                                    flags ( {0} '.format( triangleCount ) )
+        lines.append( RenderIndexList( [ 0 ] * len( iNormals ), '%08X ' ) )
+        lines.append( ')\r\n' ) #flags
+
+        lines.append( '                                )\r\n' ) #indexed_trilist
+        return ''.join( lines )
@@ -0,0 +1,70 @@
+'''
+Tests for batch_export.py that run without Blender, the add-on is replaced by a stand in for export_msts.
+'''
+
+import importlib.util
+import json
+import os
+import tempfile
+import types
+import unittest
+
+
+ScriptPath = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'io_export_mstsexporter', 'batch_export.py' )
+
+
+#####################################
+# load batch_export.py on its own, the package __init__ needs bpy
+def LoadBatchExport():
+    spec = importlib.util.spec_from_file_location( 'batch_export', ScriptPath )
+    module = importlib.util.module_from_spec( spec )
+    spec.loader.exec_module( module )
+    return module
+
+
+#####################################
+# stands in for export_msts, writes an empty file for the root collection
+class FakeExporter:
+
+    class MyException( Exception ):
+        pass
+
+    @staticmethod
+    def ExportShapeAs( context, rootNames, filepath, options ):
+        with open( filepath, 'w' ):
+            pass
+        return [ filepath ]
+
+
+class TestExportJob( unittest.TestCase ):
+
+    def setUp( self ):
+        self.batch_export = LoadBatchExport()
+        self.batch_export.bpy = types.SimpleNamespace( context=None )
+        self.batch_export.ImportAddon = lambda: FakeExporter
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup( self.folder.cleanup )
+
+    def RunExportJob( self, output ):
+        resultPath = os.path.join( self.folder.name, 'result.json' )
+        job = { 'blend':'shape.blend', 'output':output, 'root':[ 'MAIN' ], 'options':{} }
+        self.batch_export.ExportJob( job, resultPath )
+        with open( resultPath ) as f:
+            return json.load( f )
+
+    def test_missing_output_folder_is_created( self ):
+        output = os.path.join( self.folder.name, 'out', 'shapes', 'loco.s' )
+        result = self.RunExportJob( output )
+        self.assertEqual( result['status'], 'ok', result['error'] )
+        self.assertEqual( result['outputs'], [ output ] )
+        self.assertTrue( os.path.isfile( output ) )
+
+    def test_existing_output_folder( self ):
+        output = os.path.join( self.folder.name, 'loco.s' )
+        result = self.RunExportJob( output )
+        self.assertEqual( result['status'], 'ok', result['error'] )
+        self.assertTrue( os.path.isfile( output ) )
+
+
+if __name__ == '__main__':
+    unittest.main()